@@ -1,5 +1,8 @@
 function(doc) {
     if (doc.created && doc.doc_type && doc.importance > 0) {
-        emit(doc.created, null);
+        // Value is node summary, used in node lists.
+        emit(doc.created, {title: doc.title, created: doc.created,
+                           slug: doc.slug, ambiguous: doc.ambiguous,
+                           doc_type: doc.doc_type});
     }
 }
@@ -1,8 +1,9 @@
 function(doc) {
+    // Value is ambiguous flag, used to find nodes with wrong flag.
     if (doc.slug) {
-        emit(doc.slug, null);
+        emit(doc.slug, doc.ambiguous || false);
     }
     else {
-        emit(doc._id, null);
+        emit(doc._id, doc.ambiguous || false);
     }
 }
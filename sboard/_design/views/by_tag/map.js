@@ -1,7 +1,10 @@
 function(doc) {
     if (doc.tags) {
+        // Value is node summary, used in node lists.
+        var summary = {title: doc.title, created: doc.created, slug: doc.slug,
+                       ambiguous: doc.ambiguous, doc_type: doc.doc_type};
         for (var i=0; i<doc.tags.length; i++) {
-            emit(doc.tags[i], null);
+            emit(doc.tags[i], summary);
         }
     }
 }
@@ -1,5 +1,8 @@
 function(doc) {
     if (doc.parent) {
-        emit(doc.parent, null);
+        // Value is node summary, used in node lists.
+        emit(doc.parent, {title: doc.title, created: doc.created,
+                          slug: doc.slug, ambiguous: doc.ambiguous,
+                          doc_type: doc.doc_type});
     }
 }
@@ -1,8 +1,11 @@
 function(doc) {
+    // Value is node summary, used in node lists.
+    var summary = {title: doc.title, created: doc.created, slug: doc.slug,
+                   ambiguous: doc.ambiguous, doc_type: doc.doc_type};
     if (doc.parent && doc.importance > 0) {
-        emit([doc.parent, doc.created], null);
+        emit([doc.parent, doc.created], summary);
     }
     else if (doc.created && doc.doc_type && doc.importance > 0) {
-        emit(["~", doc.created], null);
+        emit(["~", doc.created], summary);
     }
 }
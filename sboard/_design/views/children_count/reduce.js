@@ -1,3 +1 @@
-function(keys, values, rereduce) {
-  return sum(values);
-}
+_count
\ No newline at end of file
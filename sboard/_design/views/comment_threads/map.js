@@ -0,0 +1,9 @@
+function(doc) {
+    if (doc.doc_type == 'Comment' && doc.thread && doc.parents) {
+        var start = doc.parents.indexOf(doc.thread);
+        if (start != -1) {
+            // Value is revision, used to validate cached comment pages.
+            emit(doc.parents.slice(start).concat([doc._id]), doc._rev);
+        }
+    }
+}
@@ -1,4 +0,0 @@
-function(doc) {
-    emit(doc._id, doc._id);
-}
-
@@ -35,11 +35,14 @@ function(doc) {
     };
 
     if (doc.title && doc.importance > 0) {
+        // Value is node summary, used in node lists.
+        var summary = {title: doc.title, created: doc.created, slug: doc.slug,
+                       ambiguous: doc.ambiguous, doc_type: doc.doc_type};
         words = get_words(doc.title);
         for (var j=0; j<words.length; j++) {
             word = words[j];
             if (word && ignore.indexOf(word) == -1) {
-                emit([word, doc.importance, doc.created], null);
+                emit([word, doc.importance, doc.created], summary);
             }
         }
     }
@@ -1,7 +1,17 @@
+import hashlib
+import time
+
 from zope.interface import implements
 
+from django.core.cache import cache
+from django.dispatch import receiver
+
 from sboard.factory import provideNode
+from sboard.models import BaseNode
 from sboard.models import Node
+from sboard.models import couch
+from sboard.models import node_post_save
+from sboard.models import node_pre_delete
 
 from .interfaces import ICategory
 
@@ -34,6 +44,126 @@ def iterate_tree(view):
                              next_level)
 
 
+# Maximum number of children of one node, returned by ``query_tree``.
+TREE_PAGE_SIZE = 50
+
+# For how long subtrees, returned by ``get_tree``, are cached.
+TREE_CACHE_TIMEOUT = 60 * 60
+
+
+def query_tree(root, depth=2, limit=TREE_PAGE_SIZE, after=None):
+    """Yields rows of subtree of ``root`` node up to ``depth`` levels deep,
+    in same order and format as rows of ``tree`` view, but with keys
+    relative to ``root``.
+
+    Each level is fetched with one ``sboard/children`` query, that returns
+    node summaries. At most ``limit`` children of each node are returned,
+    ``more`` of the last one is True, if there are more children. Children
+    of ``root`` start after ``after`` node ID, if it is given.
+    ``has_children`` of nodes on the last level tells, if they can be
+    expanded.
+    """
+    children = {}
+    parents = [root._id]
+    for level in range(depth):
+        queries = []
+        for parent in parents:
+            query = dict(startkey=parent, endkey=parent, limit=limit + 1,
+                         include_docs=False)
+            if level == 0 and after:
+                # Node ``after`` can be already deleted, so it is skipped
+                # only if it is returned.
+                query.update(startkey_docid=after, limit=limit + 2)
+            queries.append(query)
+
+        parents = []
+        for parent, rows in zip(queries, couch.multi_query('sboard/children',
+                                                           queries)):
+            rows = [dict(row, more=False) for row in rows]
+            if level == 0 and after and rows and rows[0]['id'] == after:
+                rows = rows[1:]
+            if len(rows) > limit:
+                rows = rows[:limit]
+                rows[-1]['more'] = True
+            children[parent['startkey']] = rows
+            parents.extend(row['id'] for row in rows)
+        if not parents:
+            break
+
+    counts = couch.children_counts(parents)
+
+    def walk(parent, key):
+        for row in children.get(parent, []):
+            row['key'] = key + [row['id']]
+            if row['id'] in counts:
+                row['has_children'] = counts[row['id']] > 0
+            else:
+                row['has_children'] = bool(children.get(row['id']))
+            yield row
+            for child in walk(row['id'], row['key']):
+                yield child
+
+    return walk(root._id, [])
+
+
+def get_subtree_generation(docid):
+    """Returns generation of subtree of node with ``docid``, which changes,
+    when any descendant of this node is saved, moved or deleted."""
+    key = 'sboard:subtree:%s' % docid
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, int(time.time() * 1000))
+        generation = cache.get(key)
+    return generation
+
+
+@receiver(node_post_save)
+@receiver(node_pre_delete)
+def invalidate_subtrees(sender, **kwargs):
+    """Changes subtree generations of all current and previous ancestors of
+    saved or deleted node."""
+    if not isinstance(sender, BaseNode):
+        return
+    ancestors = set(sender.parents) | set(sender._saved_parents or [])
+    sender._saved_parents = list(sender.parents)
+    cache.delete_many(['sboard:subtree:%s' % docid for docid in ancestors])
+
+
+def get_tree(root, depth=2, limit=TREE_PAGE_SIZE, after=None):
+    """Returns list of ``query_tree`` rows decorated by ``iterate_tree``.
+
+    Subtrees are cached by revision of ``root`` and its subtree generation,
+    see ``get_subtree_generation``.
+    """
+    key = repr((root._id, root._rev, get_subtree_generation(root._id), depth,
+                limit, after))
+    key = 'sboard:tree:%s' % hashlib.md5(key).hexdigest()
+    rows = cache.get(key)
+    if rows is None:
+        rows = list(iterate_tree(query_tree(root, depth, limit, after)))
+        cache.set(key, rows, TREE_CACHE_TIMEOUT)
+    return rows
+
+
+def tree_to_json(rows):
+    """Returns nested list of nodes from rows, returned by ``get_tree``."""
+    tree, stack = [], []
+    for row in rows:
+        del stack[row['level'] - 1:]
+        value = row.get('value') or {}
+        node = {
+            'id': row['id'],
+            'title': value.get('title'),
+            'slug': value.get('slug'),
+            'has_children': row['has_children'],
+            'more': row['more'],
+            'children': [],
+        }
+        (stack[-1]['children'] if stack else tree).append(node)
+        stack.append(node)
+    return tree
+
+
 class Category(Node):
     implements(ICategory)
 
@@ -1,10 +1,19 @@
 from zope.component import adapts
-from zope.component import provideAdapter
+from zope.interface import implements
 
+from sboard.factory import provideAdapter
+from sboard.interfaces import INode
+from sboard.interfaces import INodeJsonView
+from sboard.json import json_response
 from sboard.models import couch
+from sboard.nodes import BaseNodeView
 from sboard.nodes import CreateView
+from sboard.nodes import make_etag
 
 from .interfaces import ICategory
+from .models import get_subtree_generation
+from .models import get_tree
+from .models import tree_to_json
 
 
 class CategoryCreateView(CreateView):
@@ -12,10 +21,43 @@ class CategoryCreateView(CreateView):
 
     listing = True
 
+    summaries = True
+
     def get_node_list(self):
+        if self.summaries:
+            return couch.summaries('sboard/children', key=self.node._id,
+                                   limit=10)
         return couch.children(key=self.node._id, include_docs=True, limit=10)
 
 provideAdapter(CategoryCreateView, name="create")
 
 # Show category in ListView by default.
 #provideAdapter(ListView, (ICategory,))
+
+
+class TreeJsonView(BaseNodeView):
+    """Returns subtree of node as JSON, for expanding category tree on
+    demand: ``/<node>/tree.json?depth=2&after=<id>``."""
+
+    implements(INodeJsonView)
+    adapts(INode)
+
+    tree_depth = 2
+    max_tree_depth = 5
+
+    def get_tree_args(self):
+        depth = self.request.GET.get('depth', '')
+        depth = int(depth) if depth.isdigit() else self.tree_depth
+        after = self.request.GET.get('after') or None
+        return max(1, min(depth, self.max_tree_depth)), after
+
+    def get_etag(self):
+        return make_etag(self.node._rev, get_subtree_generation(self.node._id),
+                         self.get_tree_args())
+
+    def render(self, **overrides):
+        depth, after = self.get_tree_args()
+        rows = get_tree(self.node, depth, after=after)
+        return json_response(tree_to_json(rows))
+
+provideAdapter(TreeJsonView, name='tree')
@@ -5,6 +5,7 @@ from django.utils.translation import ugettext_lazy as _
 from debug_toolbar.panels import DebugPanel
 
 from .models import get_node_by_slug
+from .models import view_cache_stats
 from .views import get_node_view
 from .views import node_view
 
@@ -58,3 +59,19 @@ class NodeDebugPanel(DebugPanel):
             self.has_content = True
         else:
             self.has_content = False
+
+    def process_response(self, request, response):
+        identity_map = getattr(request, 'node_identity_map', None)
+        if identity_map is not None:
+            self.record_stats({
+                'identity_map': {
+                    'nodes': len(identity_map),
+                    'hits': identity_map.hits,
+                    'misses': identity_map.misses,
+                },
+            })
+        self.record_stats({
+            'view_cache': sorted(
+                (view, stats['hits'], stats['misses'])
+                for view, stats in view_cache_stats.items()),
+        })
@@ -1,16 +1,49 @@
+# Dispatches events to handlers registered with ``provideHandler``.
+import zope.component.event
+
+from zope.component import adapter
 from zope.component import getUtilitiesFor
 from zope.component import getUtility
+from zope.component import provideAdapter as _provideAdapter
+from zope.component import provideHandler
 from zope.component import provideUtility
 from zope.interface import Interface
 from zope.interface import directlyProvides
 from zope.interface import implementedBy
 from zope.interface import implements
+from zope.interface.interfaces import IRegistrationEvent
 
 from django.conf import settings
 from django.utils.importlib import import_module
 from django.utils.module_loading import module_has_submodule
 
 
+# Views found by ``sboard.views.get_node_view``, cached by interfaces provided
+# by node, action, name and ext.
+view_dispatch_cache = {}
+
+
+def clear_view_dispatch_cache():
+    view_dispatch_cache.clear()
+
+
+@adapter(IRegistrationEvent)
+def _registration_changed(event):
+    clear_view_dispatch_cache()
+
+# ``provide*`` functions do not send registration events, but direct calls of
+# registry methods, like ``unregisterAdapter``, do.
+provideHandler(_registration_changed)
+
+
+def provideAdapter(factory, adapts=None, provides=None, name=''):
+    """Provides view or other adapter to global component registry, like
+    ``zope.component.provideAdapter`` does, and clears view dispatch
+    cache."""
+    _provideAdapter(factory, adapts, provides, name)
+    clear_view_dispatch_cache()
+
+
 class INodeFactory(Interface): pass
 
 
@@ -38,6 +71,7 @@ def provideNode(node_class, name=""):
     node_factory = NodeFactory(node_class, name)
     directlyProvides(node_factory, implementedBy(node_class))
     provideUtility(node_factory, INodeFactory, name)
+    clear_view_dispatch_cache()
 
 
 class IViewExtFactory(Interface): pass
@@ -54,6 +88,7 @@ class ViewExtFactory(object):
 def provideViewExt(interface, ext):
     factory = ViewExtFactory(interface, ext)
     provideUtility(factory, IViewExtFactory, ext)
+    clear_view_dispatch_cache()
 
 
 def getNodeFactory(name):
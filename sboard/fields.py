@@ -5,9 +5,9 @@ from django.core.validators import EMPTY_VALUES
 from django.core.validators import RegexValidator
 from django.utils.translation import ugettext_lazy as _
 
-from couchdbkit.client import ViewResults
 from couchdbkit.exceptions import ResourceNotFound
 
+from .interfaces import IViewResults
 from .models import get_node_by_slug
 from .models import couch
 from .urls import slug
@@ -41,7 +41,7 @@ class NodeField(forms.SlugField):
 
         if node is None:
             raise forms.ValidationError(_("'%s' does not exists.") % value)
-        elif isinstance(node, ViewResults):
+        elif IViewResults.providedBy(node):
             raise forms.ValidationError(
                     _("More than one node matched '%s' slug.") % value)
         else:
@@ -42,7 +42,7 @@ class TagForm(BaseNodeForm):
 
     def clean_tag(self):
         tag = self.cleaned_data.get('tag')
-        if tag and self.node.tags and tag in self.node.tags:
+        if tag and self.node.tags and tag._id in self.node.tags:
             raise forms.ValidationError(
                 "This node already tagged with '%s' tag." % tag)
         return tag
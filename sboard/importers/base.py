@@ -1,14 +1,175 @@
+import itertools
+import multiprocessing
+import sys
+import time
+
 from sqlalchemy import MetaData
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from sboard.models import couch
+from sboard.models import get_new_ids
+
+from .models import ImportedNode
+
 metadata = MetaData()
 
 
+def _transform(args):
+    # Runs in worker processes, so must be module level function.
+    cls, node_id, data = args
+    doc = cls.transform(data)
+    if doc is not None:
+        doc['_id'] = node_id
+    return doc
+
+
+class Throughput(object):
+    """Counts processed source rows and written documents per second."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.rows = 0
+        self.docs = 0
+
+    def update(self, rows, docs):
+        self.rows += rows
+        self.docs += docs
+
+    def __str__(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return '%d rows, %d docs, %.1f rows/s, %.1f docs/s' % (
+            self.rows, self.docs, self.rows / elapsed, self.docs / elapsed)
+
+
 class MigrationBase(object):
-    def __init__(self, dbi, params=None):
+    """Base class of import scripts.
+
+    Subclasses can override ``migrate`` or provide ``query``, ``extract`` and
+    ``transform`` and let default ``migrate`` run them as a pipeline:
+
+    * rows returned by ``query`` are read in batches of ``batch_size`` using
+      server side cursor;
+
+    * ``extract`` converts each row to picklable data, it runs in main process
+      and can look up IDs of imported nodes with ``get_node_id``;
+
+    * ``transform`` converts data to node document, it runs in pool of
+      ``workers`` processes;
+
+    * documents are saved with ``couch.bulk_save``.
+
+    Node IDs of imported rows are stored in ``ImportedNode`` table, so when
+    import is started again, already imported rows are skipped.
+    """
+
+    # Name of imported data, used in ``ImportedNode`` table. Class name is
+    # used by default.
+    source = None
+
+    def __init__(self, dbi, params=None, workers=1, batch_size=500,
+                 stdout=None):
         self.params = params or {}
         engine = create_engine(dbi, echo=False)
         metadata.bind = engine
         Session = sessionmaker(bind=engine)
         self.session = Session()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stdout = stdout or sys.stdout
+        self.source = self.source or self.__class__.__name__
+
+    def query(self):
+        """Returns SQLAlchemy query of source rows."""
+        raise NotImplementedError
+
+    def get_source_id(self, row):
+        """Returns unique ID of source row."""
+        return row.id
+
+    def extract(self, row):
+        """Returns picklable data of source row, passed to ``transform``."""
+        return row
+
+    @classmethod
+    def transform(cls, data):
+        """Returns node document (dict with ``doc_type``) or None, if row
+        should be skipped."""
+        raise NotImplementedError
+
+    def get_node_id(self, source_id, source=None):
+        """Returns node ID of already imported row or None."""
+        try:
+            return ImportedNode.objects.get(
+                source=source or self.source,
+                source_id=unicode(source_id)).node_id
+        except ImportedNode.DoesNotExist:
+            return None
+
+    def iterbatches(self):
+        query = self.query().execution_options(stream_results=True)
+        rows = iter(query.yield_per(self.batch_size))
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def map_node_ids(self, source_ids):
+        """Returns dict of node IDs by ``source_ids``, new node IDs are
+        allocated and stored for rows, that were not imported yet."""
+        mapped = dict(ImportedNode.objects.filter(
+            source=self.source, source_id__in=source_ids,
+        ).values_list('source_id', 'node_id'))
+
+        new = [source_id for source_id in source_ids
+               if source_id not in mapped]
+        records = []
+        for source_id, node_id in zip(new, get_new_ids(len(new))):
+            mapped[source_id] = node_id
+            records.append(ImportedNode(source=self.source,
+                                        source_id=source_id, node_id=node_id))
+        ImportedNode.objects.bulk_create(records)
+        return mapped
+
+    def migrate_batch(self, rows, pool=None):
+        """Imports one batch of rows and returns number of written
+        documents."""
+        data = [(unicode(self.get_source_id(row)), self.extract(row))
+                for row in rows]
+        mapped = self.map_node_ids([source_id for source_id, _ in data])
+
+        # Skip rows, whose nodes are already written.
+        existing = couch.get_revs(mapped.values())
+        args = [(self.__class__, mapped[source_id], item)
+                for source_id, item in data
+                if mapped[source_id] not in existing]
+
+        if pool is None:
+            docs = map(_transform, args)
+        else:
+            docs = pool.map(_transform, args)
+
+        nodes = [couch.wrap(doc) for doc in docs if doc is not None]
+        failed = couch.bulk_save(nodes, batch_size=self.batch_size)
+        for node, error in failed:
+            if error.get('error') != 'conflict':
+                raise RuntimeError('Can not save node %s: %s' % (
+                    node._id, error.get('reason')))
+        return len(nodes) - len(failed)
+
+    def migrate(self):
+        throughput = Throughput()
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+        try:
+            for rows in self.iterbatches():
+                docs = self.migrate_batch(rows, pool)
+                throughput.update(len(rows), docs)
+                self.stdout.write('%s: %s\n' % (self.source, throughput))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return throughput
@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils.importlib import import_module
@@ -14,15 +16,25 @@ def get_class(path):
 class Command(BaseCommand):
     help = "import all content from database and convert from phpBB."
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of processes, that transform rows.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of rows read and written at once.'),
+    )
+
     def handle(self, *args, **options):
         if len(args) > 0:
-            handlers = [args.pop()]
+            handlers = [args[-1]]
         else:
             handlers = settings.SBOARD_MIGRATION_SCRIPTS.keys()
 
         for name in handlers:
-            params = settings.SBOARD_MIGRATION_SCRIPTS[name]
+            params = dict(settings.SBOARD_MIGRATION_SCRIPTS[name])
             handler_class = get_class(params.pop('handler'))
             dbi = params.pop('dbi')
-            handler = handler_class(dbi, params)
+            handler = handler_class(dbi, params, workers=options['workers'],
+                                    batch_size=options['batch_size'],
+                                    stdout=self.stdout)
             handler.migrate()
@@ -0,0 +1,21 @@
+from django.db import models
+
+
+class ImportedNode(models.Model):
+    """Maps imported source rows to nodes.
+
+    Each imported row gets node ID before it is written to CouchDB, so
+    interrupted or repeated import writes same rows to same nodes and skips
+    rows, that are already imported.
+    """
+
+    # Name of migration, for example ``phpbb.topics``.
+    source = models.CharField(max_length=64)
+
+    # Primary key of source row.
+    source_id = models.CharField(max_length=64)
+
+    node_id = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('source', 'source_id')
@@ -0,0 +1,61 @@
+import StringIO
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Table
+
+from django.test import TestCase
+
+from sboard.models import Node
+from sboard.models import couch
+
+from .base import MigrationBase
+from .base import metadata
+from .models import ImportedNode
+
+topics = Table('test_topics', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(100)),
+)
+
+
+class TopicsMigration(MigrationBase):
+    def query(self):
+        return self.session.query(topics).order_by(topics.c.id)
+
+    def extract(self, row):
+        return {'title': row.title}
+
+    @classmethod
+    def transform(cls, data):
+        return {'doc_type': 'node', 'title': data['title'].upper()}
+
+
+class TestMigration(TestCase):
+    def get_migration(self, **kwargs):
+        migration = TopicsMigration('sqlite://', stdout=StringIO.StringIO(),
+                                    batch_size=3, **kwargs)
+        if not topics.exists():
+            topics.create()
+            metadata.bind.execute(topics.insert(), [
+                {'id': i, 'title': u'Topic %d' % i} for i in range(1, 8)])
+        return migration
+
+    def test_migrate(self):
+        migration = self.get_migration(workers=2)
+        throughput = migration.migrate()
+        self.assertEqual((throughput.rows, throughput.docs), (7, 7))
+
+        mapping = dict(ImportedNode.objects.filter(
+            source='TopicsMigration').values_list('source_id', 'node_id'))
+        self.assertEqual(len(mapping), 7)
+        self.assertEqual(couch.get(mapping['2']).title, u'TOPIC 2')
+        self.assertEqual(migration.get_node_id(2), mapping['2'])
+
+        # Repeated import writes only missing nodes, using same IDs.
+        Node.get_db().delete_doc(mapping['5'])
+        throughput = migration.migrate()
+        self.assertEqual((throughput.rows, throughput.docs), (7, 1))
+        self.assertEqual(couch.get(mapping['5']).title, u'TOPIC 5')
+        self.assertEqual(ImportedNode.objects.count(), 7)
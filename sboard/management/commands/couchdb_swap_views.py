@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import get_apps
+
+from couchdbkit.ext.django.loading import couchdbkit_handler
+
+
+class Command(BaseCommand):
+    help = ("Update CouchDB design documents without downtime. New design "
+            "documents are stored under temporary IDs, their views are "
+            "built and then they are copied over current design documents, "
+            "so views stay available while they are rebuilt.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        apps = get_apps()
+        for app in apps:
+            # Queries one view of temporary design document, which returns
+            # only when all views of design document are built.
+            couchdbkit_handler.sync(app, verbosity=verbosity, temp='tmp')
+        for app in apps:
+            couchdbkit_handler.copy_designs(app, temp='tmp',
+                                            verbosity=verbosity)
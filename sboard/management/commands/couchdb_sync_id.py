@@ -1,18 +1,57 @@
+import re
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
 from django.db import connection
 from django.core.management.base import BaseCommand
 
-from sboard.models import couch, UniqueKey
+from sboard.models import Node, UniqueKey
+from sboard.models import get_key_block_size
+from sboard.models import get_key_high_water
+from sboard.models import set_key_high_water
+from sboard.utils import base36
+
+key_re = re.compile(r'^[0-9a-z]{6}$')
+
+key_chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def find_max_key(prefix, rows_per_chunk=100):
+    """Returns biggest node key starting with ``prefix`` as integer or None."""
+    db = Node.get_db()
+    kwargs = dict(startkey=prefix + u'\ufff0', endkey=prefix,
+                  descending=True, limit=rows_per_chunk)
+    while True:
+        rows = list(db.view('_all_docs', **kwargs))
+        for row in rows:
+            if key_re.match(row['id']):
+                return int(row['id'], 36)
+        if len(rows) < rows_per_chunk:
+            return None
+        kwargs.update(startkey=rows[-1]['id'], skip=1)
 
 
 class Command(BaseCommand):
-    help = "import all content from database and convert from phpBB."
+    help = ("Sync UniqueKey table auto_increment value with biggest node key "
+            "used in CouchDB.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify',
+                    default=False,
+                    help=('Also find biggest key by scanning all documents '
+                          'and compare it with stored high water mark.')),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of key ranges scanned in parallel.'),
+    )
 
-    def get_last_id(self):
-        last_id_node = couch.view('sboard/max_id', reduce=True, group=False,
-                                  include_docs=False,
-                                  startkey='000000', endkey='ffffff').one()
-        if last_id_node:
-            return int(last_id_node['value'], 36)
+    def scan_max_key(self, workers):
+        pool = ThreadPool(workers)
+        try:
+            keys = pool.map(find_max_key, key_chars)
+        finally:
+            pool.close()
+        keys = filter(None, keys)
+        return max(keys) if keys else None
 
     def reset_autoincrement(self, table, value):
         with connection.cursor() as cursor:
@@ -20,10 +59,20 @@ class Command(BaseCommand):
                            [value])
 
     def handle(self, *args, **options):
-        last_id = self.get_last_id()
+        last_id = get_key_high_water()
+        if options['verify'] or last_id is None:
+            scanned = self.scan_max_key(options['workers'])
+            print('High water mark: {}, biggest key found: {}'.format(
+                last_id and base36(last_id), scanned and base36(scanned)))
+            if scanned > last_id:
+                set_key_high_water(scanned)
+                last_id = scanned
+
         if last_id:
-            next_id = last_id + 1
+            # Each new UniqueKey record reserves a block of keys, so next
+            # autoincrement value is the first block above last used key.
+            next_block = last_id // get_key_block_size() + 1
             table_name = UniqueKey._meta.db_table
-            self.reset_autoincrement(table_name, next_id)
+            self.reset_autoincrement(table_name, next_block)
             print('Synced table "{}" auto_increment id to {}'.format(
-                table_name, next_id))
+                table_name, next_block))
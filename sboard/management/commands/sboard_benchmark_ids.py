@@ -0,0 +1,87 @@
+import threading
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from sboard.models import KeyAllocator
+from sboard.models import UniqueKey
+from sboard.utils import base36
+
+
+class Rollback(Exception):
+    pass
+
+
+def create_legacy_key():
+    """Generates key the way it was done before ``KeyAllocator``, with one
+    insert and one update per key, and rolls it back."""
+    try:
+        with transaction.atomic():
+            obj = UniqueKey()
+            obj.save()
+            obj.key = base36(obj.pk).zfill(6)
+            obj.save()
+            raise Rollback
+    except Rollback:
+        pass
+
+
+class Command(BaseCommand):
+    help = ("Measure how many node IDs per second can be generated by "
+            "concurrent workers, one by one and in blocks. Keys generated one "
+            "by one are rolled back, but blocks reserve real keys, do not run "
+            "it against production database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent workers.'),
+        make_option('--count', type='int', dest='count', default=1000,
+                    help='Number of IDs generated by each worker.'),
+    )
+
+    def run_workers(self, workers, target):
+        threads = [threading.Thread(target=target) for i in range(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def report(self, name, workers, count, duration):
+        total = workers * count
+        self.stdout.write('%s: %d IDs in %.2f s, %.0f IDs/s' % (
+            name, total, duration, total / duration))
+
+    def handle(self, *args, **options):
+        workers, count = options['workers'], options['count']
+        keys = []
+
+        def one_by_one():
+            try:
+                for i in range(count):
+                    create_legacy_key()
+            finally:
+                connection.close()
+
+        def blocks():
+            # Each worker acts as a separate process with its own allocator.
+            allocator = KeyAllocator()
+            try:
+                for i in range(count):
+                    keys.append(allocator.allocate()[0])
+            finally:
+                connection.close()
+
+        duration = self.run_workers(workers, one_by_one)
+        self.report('One by one', workers, count, duration)
+
+        duration = self.run_workers(workers, blocks)
+        self.report('KeyAllocator', workers, count, duration)
+
+        if len(set(keys)) != len(keys):
+            self.stderr.write('Duplicate IDs were generated!')
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sboard.models import couch
+from sboard.models import get_ambiguous_changes
+
+
+class Command(BaseCommand):
+    help = ("Fix ambiguous flag of all nodes, so that it is set only for "
+            "nodes, that have same slug as other nodes.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of nodes saved at once.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        rows = couch.iterchunks('sboard/by_slug', rows_per_chunk=1000)
+        changes = get_ambiguous_changes(rows)
+
+        fixed = 0
+        docids = sorted(changes)
+        for i in range(0, len(docids), batch_size):
+            nodes = couch.get_many(docids[i:i + batch_size]).values()
+            for node in nodes:
+                node.ambiguous = changes[node._id]
+            failed = couch.bulk_save(nodes)
+            for node, error in failed:
+                self.stderr.write('Failed to save %s: %s' % (node._id, error))
+            fixed += len(nodes) - len(failed)
+
+        self.stdout.write('Fixed %d nodes.' % fixed)
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sboard import markup
+from sboard.models import Node
+from sboard.models import couch
+
+
+class Command(BaseCommand):
+    help = ("Render bodies of all nodes and store rendered HTML in "
+            "``body_html``. Run this command after changing "
+            "RESTRUCTUREDTEXT_FILTER_SETTINGS.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Render all bodies, even if they are up to date.'),
+    )
+
+    def handle(self, *args, **options):
+        key = markup.get_settings_key()
+        rendered = 0
+        for node in couch.iterchunks('_all_docs', include_docs=True,
+                                     rows_per_chunk=100):
+            if not isinstance(node, Node):
+                continue
+            if 'body' not in node._doc.get('_attachments', {}):
+                continue
+            if not options['force'] and node.body_html_key == key:
+                continue
+
+            node.set_body_html(node.get_body())
+            node.save()
+            rendered += 1
+
+        self.stdout.write('Rendered %d node bodies.' % rendered)
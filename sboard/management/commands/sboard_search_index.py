@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from sboard.models import BaseNode
+from sboard.models import couch
+from sboard.search import get_search_index
+
+
+class Command(BaseCommand):
+    help = ("Rebuild full text search index from all nodes. Index file is "
+            "set by SBOARD_SEARCH_INDEX setting.")
+
+    def handle(self, *args, **options):
+        index = get_search_index()
+        if index is None:
+            raise CommandError('SBOARD_SEARCH_INDEX setting is not set.')
+
+        index.clear()
+        nodes = []
+        indexed = 0
+        for node in couch.iterchunks('_all_docs', include_docs=True,
+                                     rows_per_chunk=100):
+            if isinstance(node, BaseNode) and node.importance > 0:
+                nodes.append(node)
+            if len(nodes) >= 100:
+                index.update(nodes)
+                indexed += len(nodes)
+                nodes = []
+        index.update(nodes)
+        indexed += len(nodes)
+
+        self.stdout.write('Indexed %d nodes.' % indexed)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from sboard.models import couch
+from sboard.profiles.models import Profile
+
+
+class Command(BaseCommand):
+    help = ("Copy username, name and gravatar hash of all users to their "
+            "profile nodes.")
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.select_related('user').order_by('pk')
+        updated = 0
+        for i in range(0, profiles.count(), 100):
+            batch = list(profiles[i:i + 100])
+            nodes = couch.get_many([p.node.key for p in batch])
+            changed = []
+            for profile in batch:
+                node = nodes.get(profile.node.key)
+                if node is not None and node.set_user_data(profile.user):
+                    changed.append(node)
+            for node, error in couch.bulk_save(changed):
+                self.stderr.write('Failed to save %s: %s' % (node._id, error))
+            updated += len(changed)
+
+        self.stdout.write('Updated %d profile nodes.' % updated)
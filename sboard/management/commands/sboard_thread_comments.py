@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from sboard.models import Comment
+from sboard.models import couch
+
+
+class Command(BaseCommand):
+    help = ("Set ``thread`` of all comments to their nearest ancestor, that "
+            "is not a comment, fixing comments created before comment "
+            "threads were introduced.")
+
+    def handle(self, *args, **options):
+        comment_ids = set()
+        comments = dict(startkey=['Comment'], endkey=['Comment', {}])
+        for row in couch.iterchunks('sboard/by_type', rows_per_chunk=1000,
+                                    **comments):
+            comment_ids.add(row['id'])
+
+        updated = []
+        count = 0
+        for node in couch.iterchunks('sboard/by_type', include_docs=True,
+                                     rows_per_chunk=100, **comments):
+            if not isinstance(node, Comment):
+                continue
+            # Thread is the nearest ancestor, that is not a comment.
+            for parent in reversed(node.parents or []):
+                if parent not in comment_ids:
+                    if node.thread != parent:
+                        node.thread = parent
+                        updated.append(node)
+                    break
+            if len(updated) >= 100:
+                couch.bulk_save(updated)
+                count += len(updated)
+                updated = []
+        couch.bulk_save(updated)
+        count += len(updated)
+
+        self.stdout.write('Updated %d comments.' % count)
@@ -1,3 +1,7 @@
+import hashlib
+
+import docutils
+
 from django.conf import settings
 from django.utils.encoding import smart_str, force_unicode
 from django.utils.safestring import mark_safe
@@ -5,7 +9,17 @@ from django.utils.safestring import mark_safe
 from docutils.core import publish_parts
 
 
+def get_settings():
+    return getattr(settings, "RESTRUCTUREDTEXT_FILTER_SETTINGS", {})
+
+
+def get_settings_key():
+    """Returns a key, that changes each time markup settings change."""
+    key = repr((docutils.__version__, sorted(get_settings().items())))
+    return hashlib.md5(key).hexdigest()
+
+
 def restructuredtext(value):
-    docutils_settings = getattr(settings, "RESTRUCTUREDTEXT_FILTER_SETTINGS", {})
+    docutils_settings = get_settings()
     parts = publish_parts(source=smart_str(value), writer_name="html4css1", settings_overrides=docutils_settings)
     return mark_safe(force_unicode(parts["fragment"]))
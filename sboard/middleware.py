@@ -0,0 +1,19 @@
+from .models import activate_identity_map
+from .models import deactivate_identity_map
+
+
+class NodeIdentityMapMiddleware(object):
+    """Activates request scoped node identity map.
+
+    With this middleware enabled, each node is fetched from CouchDB at most
+    once per request. Identity map of current request is available as
+    ``request.node_identity_map``.
+
+    """
+
+    def process_request(self, request):
+        request.node_identity_map = activate_identity_map()
+
+    def process_response(self, request, response):
+        deactivate_identity_map()
+        return response
@@ -1,26 +1,51 @@
+from __future__ import absolute_import
+
+import StringIO
+import base64
+import collections
 import datetime
+import fcntl
 import functools
+import glob
+import hashlib
 import itertools
+import json
+import logging
+import mimetypes
+import operator
 import os
 import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from zope.interface import implements
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.db import close_old_connections
 from django.db import models
-from django.db import transaction
 from django.dispatch import Signal
+from django.dispatch import receiver
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from couchdbkit.exceptions import BadValueError
-from couchdbkit.exceptions import MultipleResultsFound
+from couchdbkit.exceptions import BulkSaveError
 from couchdbkit.exceptions import NoResultFound
+from couchdbkit.exceptions import RequestFailed
+from couchdbkit.exceptions import ResourceConflict
 from couchdbkit.exceptions import ResourceNotFound
 from couchdbkit.ext.django import schema
 from couchdbkit.ext.django.loading import couchdbkit_handler
 
+from PIL import Image as PILImage
+
 from sorl.thumbnail import get_thumbnail
 
 from docutils.parsers.rst import directives
@@ -35,12 +60,17 @@ from .interfaces import INode
 from .interfaces import IRoot
 from .interfaces import ITag
 from .interfaces import ITagsChange
+from .interfaces import IViewResults
 from .interfaces import IPage
 from .permissions import Permissions
 from .utils import base36
 from sboard import markup
+from sboard import pagination
+
+logger = logging.getLogger(__name__)
 
 node_pre_delete = Signal()
+node_post_save = Signal()
 
 class DocTypeMap(dict):
     """Special dict, that provides doc_type map for instances returned by view.
@@ -90,8 +120,7 @@ class SboardCouchViews(object):
         return self._doc_type_map
 
     def __getattr__(self, attr):
-        return functools.partial(Node.view, 'sboard/%s' % attr,
-                                 classes=self.get_doc_type_map(), **self.kwargs)
+        return functools.partial(self.view, 'sboard/%s' % attr, **self.kwargs)
 
     def wrap(self, data):
         # TODO: change doc_type to node_type
@@ -100,8 +129,154 @@ class SboardCouchViews(object):
 
     def get(self, docid, rev=None):
         assert docid, "``docid`` can't be empty"
+        identity_map = get_identity_map() if rev is None else None
+        if identity_map is not None:
+            node = identity_map.get(docid)
+            if node is not None:
+                return node
+
+        db = Node.get_db()
+        node = db.get(docid, rev=rev, wrapper=self.wrap)
+        if identity_map is not None:
+            identity_map.add(node)
+        return node
+
+    def get_many(self, docids):
+        """Returns dict of nodes by given ``docids``.
+
+        All nodes, that are not already in identity map, are fetched using one
+        ``_all_docs?keys=`` request. Not existing nodes are not included in
+        returned dict.
+        """
+        identity_map = get_identity_map()
+        nodes, missing, seen = {}, [], set()
+        for docid in docids:
+            if not docid or docid in seen:
+                continue
+            seen.add(docid)
+            node = identity_map.get(docid) if identity_map is not None else None
+            if node is None:
+                missing.append(docid)
+            else:
+                nodes[docid] = node
+
+        if missing:
+            db = Node.get_db()
+            for row in db.view('_all_docs', keys=missing, include_docs=True):
+                if row.get('doc') is None:
+                    continue
+                node = self.wrap(row['doc'])
+                if identity_map is not None:
+                    identity_map.add(node)
+                nodes[node._id] = node
+
+        return nodes
+
+    def get_revs(self, docids):
+        """Returns dict of current revisions by given ``docids``.
+
+        Revisions are fetched using one ``_all_docs?keys=`` request, without
+        fetching documents themselves.
+        """
+        revs = {}
         db = Node.get_db()
-        return db.get(docid, rev=rev, wrapper=self.wrap)
+        for row in db.view('_all_docs', keys=list(docids)):
+            value = row.get('value')
+            if value and not value.get('deleted'):
+                revs[row['id']] = value['rev']
+        return revs
+
+    def bulk_save(self, nodes, batch_size=100):
+        """Saves ``nodes`` using one ``_bulk_docs`` request per ``batch_size``
+        nodes.
+
+        Nodes without ID get new IDs. ``_rev`` of saved nodes is updated.
+        Returns list of ``(node, error)`` tuples of nodes, that were not
+        saved, where ``error`` is CouchDB result, for example
+        ``{'id': ..., 'error': 'conflict', 'reason': ...}``.
+        """
+        nodes = list(nodes)
+        new = [node for node in nodes if not node._id]
+        for node, key in zip(new, get_new_ids(len(new))):
+            node._id = key
+
+        failed, others = [], []
+        for i in range(0, len(nodes), batch_size):
+            batch = nodes[i:i + batch_size]
+            others.extend(reconcile_slugs(batch))
+
+            # Nodes can be stored in different databases.
+            by_db = collections.OrderedDict()
+            for node in batch:
+                node.prepare_bulk_save()
+                by_db.setdefault(node.get_db(), []).append(node)
+
+            for db, docs in by_db.items():
+                try:
+                    db.save_docs(docs)
+                except BulkSaveError as e:
+                    results = e.results
+                else:
+                    results = [{} for doc in docs]
+
+                saved = []
+                for node, result in zip(docs, results):
+                    if 'error' in result:
+                        failed.append((node, result))
+                    else:
+                        node.after_bulk_save()
+                        saved.append(node)
+
+                invalidate_view_cache()
+                invalidate_slugs(saved)
+                for node in saved:
+                    node_post_save.send(sender=node)
+
+        # Conflicts are ignored, other writer has saved node already.
+        if others:
+            self.bulk_save(others, batch_size)
+        return failed
+
+    def children_counts(self, ids):
+        """Returns dict of children counts by parent ``ids``, using one
+        request."""
+        ids = list(ids)
+        counts = dict.fromkeys(ids, 0)
+        if ids:
+            for row in self.rows('sboard/children_count', keys=ids,
+                                 group=True):
+                counts[row['key']] = row['value']
+        return counts
+
+    def latest_children(self, ids, limit=3):
+        """Returns dict of lists of ``limit`` newest children by parent
+        ``ids``, using one request."""
+        ids = list(ids)
+        queries = [dict(startkey=[key, u'\ufff0'], endkey=[key],
+                        descending=True, limit=limit, include_docs=True)
+                   for key in ids]
+        children = {}
+        results = self.multi_query('sboard/children_by_date', queries)
+        for key, rows in zip(ids, results):
+            children[key] = [self.wrap(row['doc']) for row in rows
+                             if row.get('doc')]
+        return children
+
+    def multi_query(self, view, queries):
+        """Query ``view`` with each dict of parameters in ``queries`` and
+        return list of row lists.
+
+        All queries are sent in one request, if CouchDB supports multiple
+        queries (2.2 or later), otherwise view is queried once for each query.
+        """
+        db = Node.get_db()
+        design, name = view.split('/', 1)
+        path = '/_design/%s/_view/%s/queries' % (design, name)
+        try:
+            response = db.res.post(path, payload={'queries': queries})
+        except (ResourceNotFound, RequestFailed):
+            return [list(db.view(view, **query)) for query in queries]
+        return [result['rows'] for result in response.json_body['results']]
 
     def check_kwargs(self, kwargs):
         # slice key
@@ -116,29 +291,245 @@ class SboardCouchViews(object):
                 kwargs.update(dict(startkey=skey, endkey=ekey))
 
     def view(self, view, **kwargs):
+        """Query ``view`` and wrap returned documents to node instances.
+
+        If ``prefetch`` is given, then all nodes referenced by listed
+        ``NodeProperty`` attributes are fetched for whole result set at once
+        and list of nodes is returned instead of lazy ``ViewResults``::
+
+            couch.children(key=node._id, prefetch=('image', 'parent'))
+
+        """
+        prefetch = kwargs.pop('prefetch', None)
         self.check_kwargs(kwargs)
         kwargs.setdefault('include_docs', True)
         kwargs.setdefault('classes', self.get_doc_type_map())
-        return Node.view(view, **kwargs)
+        timeout = get_view_cache_timeout(view)
+        if timeout is not None and kwargs['include_docs']:
+            kwargs.pop('classes')
+            results = CachedViewResults(
+                self.wrap_row(row)
+                for row in get_cached_rows(view, kwargs, timeout)
+                if row.get('doc') is not None)
+        else:
+            results = Node.view(view, **kwargs)
+        if prefetch:
+            results = results.all()
+            prefetch_nodes(prefetch, results)
+        return results
+
+    def rows(self, view, **kwargs):
+        """Query ``view`` and return raw, not wrapped, rows."""
+        self.check_kwargs(kwargs)
+        timeout = get_view_cache_timeout(view)
+        if timeout is not None:
+            return CachedViewResults(get_cached_rows(view, kwargs, timeout))
+        return Node.get_db().view(view, **kwargs)
 
     def iterchunks(self, view, **kwargs):
+        """Iterate over all view rows, fetching ``rows_per_chunk`` rows at
+        once.
+
+        If ``include_docs`` is True, then wrapped nodes are returned, otherwise
+        raw rows are returned. Documents, that are not nodes, are skipped.
+        ``prefetch`` works same way as in ``view``, but for each chunk.
+        """
+        prefetch = kwargs.pop('prefetch', None)
+        rows_per_chunk = kwargs.pop('rows_per_chunk', 50)
+        include_docs = kwargs.get('include_docs', False)
         counter = None
-        rows_per_chunk = 50
         while counter is None or counter > rows_per_chunk:
             counter = 0
             kwargs['limit'] = rows_per_chunk + 1
-            for row in self.view(view, **kwargs):
+            chunk = []
+            for row in self.rows(view, **kwargs):
                 counter += 1
                 if counter > rows_per_chunk:
                     kwargs['startkey'] = row['key']
                     kwargs['startkey_docid'] = row['id']
-                else:
-                    yield row
+                elif not include_docs:
+                    chunk.append(row)
+                elif row.get('doc') and 'doc_type' in row['doc']:
+                    # Skip deleted and design documents.
+                    chunk.append(self.wrap(row['doc']))
+            if prefetch and include_docs:
+                prefetch_nodes(prefetch, chunk)
+            for row in chunk:
+                yield row
+
+    def paginate(self, view, token=None, limit=50, **kwargs):
+        """Returns one ``sboard.pagination.Page`` of nodes from ``view``.
+
+        ``token`` is ``next_token`` or ``previous_token`` of other page of same
+        view with same arguments, if token is None, first page is returned::
+
+            page = couch.paginate('sboard/children', key=node._id, limit=10)
+            page = couch.paginate('sboard/children', key=node._id, limit=10,
+                                  token=page.next_token)
+
+        If ``summaries`` is True, then page contains ``NodeSummary`` objects
+        instead of nodes, view must emit node summaries as values.
+        """
+        prefetch = kwargs.pop('prefetch', None)
+        summaries = kwargs.pop('summaries', False)
+        self.check_kwargs(kwargs)
+        if summaries:
+            kwargs['include_docs'] = False
+            wrap = self.wrap_summary
+        else:
+            kwargs.setdefault('include_docs', True)
+            wrap = self.wrap_row
+        page = pagination.paginate(
+            functools.partial(self.rows, view), wrap, token=token,
+            limit=limit, **kwargs)
+        if prefetch:
+            prefetch_nodes(prefetch, page.objects)
+        return page
+
+    def wrap_row(self, row):
+        return self.wrap(row['doc'])
+
+    def wrap_summary(self, row):
+        return NodeSummary(row['id'], row['value'])
+
+    def summaries(self, view, **kwargs):
+        """Query ``view``, that emits node summaries, and return list of
+        ``NodeSummary`` objects, without fetching documents."""
+        kwargs['include_docs'] = False
+        return [self.wrap_summary(row) for row in self.rows(view, **kwargs)]
 
 
 couch = SboardCouchViews()
 
 
+class NodeIdentityMap(object):
+    """Maps node ids to already wrapped node instances.
+
+    While an identity map is active (see ``NodeIdentityMapMiddleware``), each
+    document is fetched from CouchDB at most once and the same node instance
+    is returned for every ``couch.get`` call with the same id.
+
+    ``hits`` and ``misses`` counters show how many lookups were served from the
+    map and how many had to go to the database.
+
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, docid):
+        return docid in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, docid):
+        node = self.nodes.get(docid)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def add(self, node):
+        self.nodes[node._id] = node
+
+    def discard(self, docid):
+        self.nodes.pop(docid, None)
+
+
+_local = threading.local()
+
+
+def get_identity_map():
+    """Returns identity map of current thread or None if it is not active."""
+    return getattr(_local, 'identity_map', None)
+
+
+def activate_identity_map():
+    _local.identity_map = NodeIdentityMap()
+    return _local.identity_map
+
+
+def deactivate_identity_map():
+    _local.identity_map = None
+
+
+# Cached view results are valid only while this generation does not change.
+# It is changed after each write of nodes.
+VIEW_CACHE_GENERATION_KEY = 'sboard:view-cache:generation'
+
+view_cache_stats = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+
+def get_view_cache_timeout(view):
+    """Returns for how many seconds results of ``view`` are cached, or None
+    if they are not cached.
+
+    Cached views and their timeouts are set by ``SBOARD_VIEW_CACHE`` setting,
+    for example ``{'sboard/children_by_date': 60}``.
+    """
+    return getattr(settings, 'SBOARD_VIEW_CACHE', {}).get(view)
+
+
+def invalidate_view_cache():
+    """Invalidates all cached view results."""
+    try:
+        cache.incr(VIEW_CACHE_GENERATION_KEY)
+    except ValueError:
+        cache.add(VIEW_CACHE_GENERATION_KEY, int(time.time() * 1000))
+
+
+def get_view_cache_generation():
+    """Returns current generation of view cache, which changes after each
+    write of nodes."""
+    generation = cache.get(VIEW_CACHE_GENERATION_KEY)
+    if generation is None:
+        cache.add(VIEW_CACHE_GENERATION_KEY, int(time.time() * 1000))
+        generation = cache.get(VIEW_CACHE_GENERATION_KEY)
+    return generation
+
+
+class CachedViewResults(list):
+    """List of view results read from view cache, with the same ``all``,
+    ``first`` and ``count`` methods as ``ViewResults``."""
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        return self[0] if self else None
+
+    def count(self):
+        return len(self)
+
+
+def get_cached_rows(view, params, timeout):
+    """Returns list of raw ``view`` rows queried with ``params``, read from
+    cache if cached rows are not stale.
+
+    Generation and cached rows are read with one ``cache.get_many`` call.
+    """
+    key = json.dumps([view, params], sort_keys=True, default=repr)
+    key = 'sboard:view:%s' % hashlib.md5(key).hexdigest()
+    values = cache.get_many([VIEW_CACHE_GENERATION_KEY, key])
+    generation = values.get(VIEW_CACHE_GENERATION_KEY)
+    entry = values.get(key)
+    stats = view_cache_stats[view]
+    if generation is not None and entry and entry[0] == generation:
+        stats['hits'] += 1
+        return entry[1]
+
+    stats['misses'] += 1
+    if generation is None:
+        generation = get_view_cache_generation()
+    rows = Node.get_db().view(view, **params).all()
+    cache.set(key, (generation, rows), timeout)
+    return rows
+
+
 def parse_node_slug(slug):
     if slug and '+' in slug:
         return slug.split('+')
@@ -146,8 +537,55 @@ def parse_node_slug(slug):
         return slug, None
 
 
+# For how long IDs of nodes with same slug are cached.
+SLUG_CACHE_TIMEOUT = 24 * 60 * 60
+
+# For how long not existing slugs are cached.
+SLUG_NEGATIVE_CACHE_TIMEOUT = 5 * 60
+
+
+class AmbiguousNodes(list):
+    """List of nodes with same slug."""
+    implements(IViewResults)
+
+
+def get_slug_cache_key(slug):
+    return 'sboard:slug:%s' % hashlib.md5(slug.encode('utf-8')).hexdigest()
+
+
+def get_slug_ids(slug, cached=True):
+    """Returns list of IDs of nodes with ``slug``, empty if there are no
+    such nodes.
+
+    IDs are cached and cache is invalidated, when node is saved with new or
+    changed slug or deleted.
+    """
+    key = get_slug_cache_key(slug)
+    if cached:
+        ids = cache.get(key)
+        if ids is not None:
+            return ids
+
+    ids = [row['id'] for row in couch.rows('sboard/by_slug', key=slug,
+                                           limit=20)]
+    cache.set(key, ids,
+              SLUG_CACHE_TIMEOUT if ids else SLUG_NEGATIVE_CACHE_TIMEOUT)
+    return ids
+
+
+def invalidate_slugs(nodes):
+    """Invalidates cached IDs of current and previous slugs of ``nodes``."""
+    slugs = set()
+    for node in nodes:
+        # Nodes without slug are found by ID.
+        slugs.update([node._id, node.slug])
+        if node._saved_breadcrumb is not None:
+            slugs.add(node._saved_breadcrumb['slug'])
+    cache.delete_many([get_slug_cache_key(slug) for slug in slugs if slug])
+
+
 def get_node_by_slug(slug=None):
-    """Returns Node instance, None or ViewResults instance."""
+    """Returns Node instance, None or ``AmbiguousNodes`` list."""
     slug, key = parse_node_slug(slug)
     if key:
         try:
@@ -158,13 +596,22 @@ def get_node_by_slug(slug=None):
     if slug is None or slug == '~':
         return getRootNode()
 
-    query = couch.by_slug(key=slug, limit=20)
-    try:
-        return query.one(except_all=True)
-    except MultipleResultsFound:
-        return query
-    except (ResourceNotFound, NoResultFound):
-        return None
+    # If cached IDs are stale, they are queried again.
+    for cached in (True, False):
+        ids = get_slug_ids(slug, cached)
+        if not ids:
+            return None
+        elif len(ids) == 1:
+            try:
+                return couch.get(ids[0])
+            except ResourceNotFound:
+                continue
+        else:
+            nodes = couch.get_many(ids)
+            if len(nodes) == len(ids) or not cached:
+                return AmbiguousNodes(nodes[docid] for docid in ids
+                                      if docid in nodes)
+    return None
 
 
 class NodeRef(object):
@@ -196,9 +643,11 @@ class NodeRef(object):
 
 
 class NodeProperty(schema.Property):
-    def __init__(self, *args, **kwargs):
-        self._ref = NodeRef()
-        super(NodeProperty, self).__init__(*args, **kwargs)
+    """Reference to other node.
+
+    Each document instance gets its own ``NodeRef``, so referenced node, once
+    fetched or assigned, stays cached on that document instance.
+    """
 
     def validate(self, value, required=True):
         value = super(NodeProperty, self).validate(value, required)
@@ -208,17 +657,37 @@ class NodeProperty(schema.Property):
                     self.name, type(value).__name__))
         return value
 
+    def __get__(self, document_instance, document_class):
+        if document_instance is None:
+            return self
+
+        value = document_instance._doc.get(self.name)
+        if not value:
+            return None
+
+        ref = self._get_ref(document_instance)
+        ref._set_id(value)
+        return ref
+
     def __set__(self, document_instance, value):
         if isinstance(value, BaseNode):
-            self._ref._set_node(value)
-            value = self._ref
+            ref = self._get_ref(document_instance)
+            ref._set_node(value)
+            value = ref
         super(NodeProperty, self).__set__(document_instance, value)
 
+    def _get_ref(self, document_instance):
+        refs = document_instance.__dict__.setdefault('_noderefs', {})
+        if self.name not in refs:
+            refs[self.name] = NodeRef()
+        return refs[self.name]
+
     def to_python(self, value):
         if not value:
             return None
-        self._ref._set_id(value)
-        return self._ref
+        ref = NodeRef()
+        ref._set_id(value)
+        return ref
 
     def to_json(self, value):
         if value:
@@ -289,13 +758,24 @@ class NodeForeignKey(models.CharField):
 
 
 class UniqueKeyManager(models.Manager):
-    @transaction.atomic
     def create(self):
+        """Returns not saved ``UniqueKey`` with new key from
+        ``key_allocator``.
+
+        Each stored record reserves a whole block of keys, so a record per key
+        is not stored.
+        """
+        return UniqueKey(key=key_allocator.allocate()[0])
+
+    def create_block(self):
+        """Reserves new block of keys, using one insert.
+
+        Returns block number, all keys from ``number * block_size`` to
+        ``(number + 1) * block_size - 1`` belong to this block.
+        """
         obj = UniqueKey()
         obj.save()
-        obj.key = base36(obj.pk).zfill(6)
-        obj.save()
-        return obj
+        return obj.pk
 
     def last_key(self):
         return self.latest('pk')._id
@@ -309,6 +789,10 @@ class UniqueKey(models.Model):
 
     Generated key is 6 characters length and can identify 2 176 782 335 nodes.
 
+    New keys are allocated by ``KeyAllocator`` in blocks, where each record
+    without ``key`` reserves one block of keys. ``UniqueKey.objects.create``
+    takes keys from same blocks, without storing new records.
+
     XXX: Thsese tests or whole UniqueKey model should be refactored, since now,
     id is not predictible, because now fixtures have user, and that user
     triggers signal that creates profile not for that user and UniqueKey
@@ -329,21 +813,226 @@ class UniqueKey(models.Model):
     objects = UniqueKeyManager()
 
 
+def get_key_block_size():
+    """Number of keys reserved by one ``UniqueKey`` record.
+
+    ``SBOARD_KEY_BLOCK_SIZE`` can be increased, but must never be decreased,
+    otherwise new blocks will overlap with already allocated keys.
+    """
+    return getattr(settings, 'SBOARD_KEY_BLOCK_SIZE', 100)
+
+
+class KeyAllocator(object):
+    """Hi/lo unique key allocator.
+
+    Keys are reserved in blocks of ``get_key_block_size()`` keys using one SQL
+    insert per block, and handed out from memory until block is exhausted.
+    Since block number is an autoincrement value of the same table, that was
+    used to generate keys one by one, all blocks start above previously
+    generated keys.
+
+    Allocator is thread safe and each process gets its own blocks, even if
+    allocator was created before fork.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+
+    def _reserve_block(self):
+        block_size = get_key_block_size()
+        number = UniqueKey.objects.create_block()
+        self._next = number * block_size
+        self._end = self._next + block_size
+        self._pid = os.getpid()
+        set_key_high_water(self._end - 1)
+
+    def allocate(self, count=1):
+        """Returns list of ``count`` new unique keys."""
+        keys = []
+        with self._lock:
+            if self._pid != os.getpid():
+                self._next = self._end = 0
+            while len(keys) < count:
+                if self._next >= self._end:
+                    self._reserve_block()
+                keys.append(base36(self._next).zfill(6))
+                self._next += 1
+        return keys
+
+
+key_allocator = KeyAllocator()
+
+
+# ID of CouchDB document, that holds biggest reserved key.
+KEY_HIGH_WATER_DOC = 'sboard-key-high-water'
+
+
+def get_key_high_water():
+    """Returns biggest key ever reserved by ``KeyAllocator`` as integer or
+    None if it is not known."""
+    try:
+        doc = Node.get_db().get(KEY_HIGH_WATER_DOC)
+    except ResourceNotFound:
+        return None
+    return int(doc['key'], 36)
+
+
+def set_key_high_water(value):
+    """Stores ``value`` as biggest reserved key, unless bigger key is already
+    stored."""
+    db = Node.get_db()
+    while True:
+        try:
+            doc = db.get(KEY_HIGH_WATER_DOC)
+        except ResourceNotFound:
+            doc = {'_id': KEY_HIGH_WATER_DOC, 'key': '0'}
+        if int(doc['key'], 36) >= value:
+            return
+        doc['key'] = base36(value).zfill(6)
+        try:
+            db.save_doc(doc)
+            return
+        except ResourceConflict:
+            # Other process has updated high water mark, check it again.
+            pass
+
+
 def get_new_id():
-    return UniqueKey.objects.create().key._id
+    return key_allocator.allocate()[0]
 
 
+def get_new_ids(count):
+    return key_allocator.allocate(count)
 
 
-def set_nodes_ambiguous(nodes):
-    """Sets all nodes as ambiguous if not set already."""
-    for node in nodes:
-        if not node.ambiguous:
-            node.ambiguous = True
-            node.save()
+def get_ambiguous_changes(slug_rows):
+    """Returns dict of correct ``ambiguous`` flags by node ID, for nodes,
+    whose flag is wrong.
 
+    ``slug_rows`` are rows of ``sboard/by_slug`` view, sorted by key.
+    """
+    changes = {}
+    for slug, rows in itertools.groupby(slug_rows, lambda row: row['key']):
+        rows = list(rows)
+        ambiguous = len(rows) > 1
+        for row in rows:
+            if bool(row['value']) != ambiguous:
+                changes[row['id']] = ambiguous
+    return changes
+
+
+def reconcile_slugs(nodes, deleted=False):
+    """Sets ``ambiguous`` flag of ``nodes``, that are about to be saved
+    with new or changed slug, or deleted if ``deleted`` is True. Nodes
+    without slug are found by ID and are never ambiguous, so they are skipped.
+
+    Other nodes with same slugs are fetched using one ``by_slug`` query and
+    returned, if their ``ambiguous`` flag must be changed too, so that
+    caller could save them.
+    """
+    by_id = dict((node._id, node) for node in nodes)
+    changed = [node for node in nodes if deleted or
+               node._saved_breadcrumb is None or
+               node._saved_breadcrumb['slug'] != node.slug]
+    slugs = set()
+    for node in changed:
+        slugs.add(node.slug)
+        if node._saved_breadcrumb is not None:
+            slugs.add(node._saved_breadcrumb['slug'])
+    slugs.discard(None)
+    slugs.discard('')
+    if not slugs:
+        return []
+
+    changed_ids = set(node._id for node in changed)
+    rows = [row for row in couch.rows('sboard/by_slug', keys=sorted(slugs))
+            if row['id'] not in changed_ids]
+    if not deleted:
+        for node in changed:
+            if node.slug:
+                rows.append({'key': node.slug, 'id': node._id,
+                             'value': node.ambiguous})
+    rows.sort(key=lambda row: row['key'])
+
+    changes = get_ambiguous_changes(rows)
+    for docid in list(changes):
+        if docid in by_id:
+            by_id[docid].ambiguous = changes.pop(docid)
+
+    others = couch.get_many(changes).values()
+    for node in others:
+        node.ambiguous = changes[node._id]
+    return others
+
+
+class NodeUrlsMixin(object):
+    """Methods for building node urls, shared by nodes and node summaries."""
+
+    __slots__ = ()
 
-class BaseNode(schema.Document):
+    def get_slug(self):
+        return self.slug or self._id
+
+    def get_slug_with_key(self):
+        if self.slug:
+            return '%s+%s' % (self.slug, self._id)
+        else:
+            return '+%s' % (self._id,)
+
+    def urlslug(self):
+        if self.ambiguous and self.slug:
+            return self.get_slug_with_key()
+        else:
+            return self.get_slug()
+
+    def permalink(self, *args, **kwargs):
+        name = 'node'
+        args = (self.urlslug(),) + args
+        ext = kwargs.get('ext')
+        if ext:
+            args += (ext,)
+            name = 'node_ext'
+        return reverse(name, args=args)
+
+
+class NodeSummary(NodeUrlsMixin):
+    """Read-only node projection, that holds only fields needed for node
+    lists.
+
+    Summaries are created from values of views, that emit node summary, so
+    node documents are not fetched and wrapped.
+    """
+
+    __slots__ = ('_id', 'title', 'created', 'slug', 'ambiguous', 'doc_type')
+
+    def __init__(self, docid, value):
+        self._id = docid
+        self.title = value.get('title')
+        self.created = parse_datetime(value.get('created'))
+        self.slug = value.get('slug')
+        self.ambiguous = value.get('ambiguous', False)
+        self.doc_type = value.get('doc_type')
+
+    def __repr__(self):
+        return '<NodeSummary %s>' % self._id
+
+    @property
+    def key(self):
+        return self._id
+
+    def get_title(self):
+        return self.title
+
+
+def parse_datetime(value):
+    """Parses datetime stored by ``schema.DateTimeProperty``."""
+    if value:
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+class BaseNode(NodeUrlsMixin, schema.Document):
     # Node slug, that is used to get node from human readable url address.
     slug = schema.StringProperty()
 
@@ -370,6 +1059,10 @@ class BaseNode(schema.Document):
     # TODO: rename ``parents`` to ``ancestors``
     parents = schema.ListProperty()
 
+    # Titles and slugs of ``parents``, used to show breadcrumbs without
+    # fetching ancestors. Updated in background, when ancestor is renamed.
+    breadcrumbs = schema.ListProperty()
+
     # Node tags. Each item in this list is reference to a node.
     tags = schema.ListProperty()
 
@@ -399,10 +1092,25 @@ class BaseNode(schema.Document):
 
     _parent = None
 
+    # Set by ``prefetch_children``.
+    _children_count = None
+    _latest_children = None
+
     def __init__(self, *args, **kwargs):
         self._properties['importance'].default = self._default_importance
         self._permissions = None
         super(BaseNode, self).__init__(*args, **kwargs)
+        # Breadcrumb of saved node, used to find out, if node was renamed.
+        self._saved_breadcrumb = None
+        # Ancestors of saved node, used to find out, if node was moved.
+        self._saved_parents = None
+
+    @classmethod
+    def wrap(cls, data):
+        node = super(BaseNode, cls).wrap(data)
+        node._saved_breadcrumb = node.get_breadcrumb()
+        node._saved_parents = list(node.parents)
+        return node
 
     def __repr__(self):
         class_name = self.__class__.__name__
@@ -440,32 +1148,8 @@ class BaseNode(schema.Document):
             cls._db = db
         return db
 
-    def get_slug(self):
-        return self.slug or self._id
-
-    def get_slug_with_key(self):
-        if self.slug:
-            return '%s+%s' % (self.slug, self._id)
-        else:
-            return '+%s' % (self._id,)
-
-    def urlslug(self):
-        if self.ambiguous and self.slug:
-            return self.get_slug_with_key()
-        else:
-            return self.get_slug()
-
-    def permalink(self, *args, **kwargs):
-        name = 'node'
-        args = (self.urlslug(),) + args
-        ext = kwargs.get('ext')
-        if ext:
-            args += (ext,)
-            name = 'node_ext'
-        return reverse(name, args=args)
-
     def get_new_id(self):
-        return UniqueKey.objects.create().key._id
+        return get_new_id()
 
     def set_new_id(self):
         self._id = self.get_new_id()
@@ -476,20 +1160,14 @@ class BaseNode(schema.Document):
         return couch.children(key=self.get_id, include_docs=True)
 
     def get_children_count(self):
-        res = couch.children_count(key=self.get_id, group=True,
-                                   include_docs=False).all()
-        if(len(res) == 0):
-            return 0
-        return res[0]['value']
+        if self._children_count is None:
+            self._children_count = couch.children_counts([self._id])[self._id]
+        return self._children_count
 
     def get_latest_children(self):
-        return couch.children_by_date(
-            limit=3,
-            descend=True,
-            include_docs=True,
-            startkey=[self.get_id, '0000-00-00T00:00:00'],
-            endkey=[self.get_id, '9999-99-99T99:99:99'],
-        )
+        if self._latest_children is None:
+            self._latest_children = couch.latest_children([self._id])[self._id]
+        return self._latest_children
 
     def has_parent(self):
         # TODO: this method is not needed any more in favor of self.parent
@@ -500,26 +1178,56 @@ class BaseNode(schema.Document):
             if self.parent:
                 # TODO: returned instance must be mapped to model described in
                 # ``doc_type``.
-                self._parent = self.get(self.parents[-1])
+                self._parent = couch.get(self.parents[-1])
         return self._parent
 
     def get_ancestors(self):
-        if self.parent:
-            return couch.ancestors(key=self._id)
-        else:
-            return []
+        """Returns list of ancestor nodes, root first, fetched using one
+        ``_all_docs?keys=`` request."""
+        ancestors = couch.get_many(self.parents or [])
+        return [ancestors[docid] for docid in self.parents
+                if docid in ancestors]
+
+    def get_breadcrumb(self):
+        """Returns data of this node, stored in ``breadcrumbs`` of its
+        descendants."""
+        return {
+            '_id': self._id,
+            'title': self.title,
+            'slug': self.slug,
+            'ambiguous': self.ambiguous,
+            'doc_type': self._doc.get('doc_type'),
+        }
+
+    def get_breadcrumbs(self):
+        """Returns list of ``NodeSummary`` of ancestors, root first.
+
+        Ancestors are read from ``breadcrumbs``. Ancestors missing there, for
+        example of nodes saved before ``breadcrumbs`` were added, are read
+        using ``fetch_breadcrumbs``.
+        """
+        crumbs = dict((crumb['_id'], crumb) for crumb in self.breadcrumbs)
+        missing = [docid for docid in self.parents if docid not in crumbs]
+        if missing:
+            crumbs.update(fetch_breadcrumbs(missing))
+        return [NodeSummary(docid, crumbs[docid]) for docid in self.parents
+                if docid in crumbs]
 
     def set_parent(self, parent):
         self.parent = parent
         self.set_parents(parent)
 
     def set_parents(self, parent):
-        """Sets ``parents`` property by given parent node."""
+        """Sets ``parents`` and ``breadcrumbs`` properties by given parent
+        node."""
         if parent:
             self.parents = list(parent.parents) or []
             self.parents.append(parent._id)
+            self.breadcrumbs = [dict(crumb) for crumb in parent.breadcrumbs]
+            self.breadcrumbs.append(parent.get_breadcrumb())
         else:
             self.parents = []
+            self.breadcrumbs = []
 
     def is_root(self):
         return IRoot.providedBy(self)
@@ -539,7 +1247,13 @@ class BaseNode(schema.Document):
             geometry = '%dx%d' % (size, size)
             return self.image.ref.thumbnail(geometry=geometry).url
 
-    def set_image(self, data, ext):
+    def set_image(self, data, ext, save=True):
+        """Sets image node with ``data`` file as node image.
+
+        Image node and its file are saved with one request. If ``save`` is
+        False, image node is not saved, save it together with this node using
+        ``couch.bulk_save``.
+        """
         if self.image:
             image = self.image.ref
         else:
@@ -548,24 +1262,49 @@ class BaseNode(schema.Document):
         image.title = self.title
         image.set_parent(self)
         image.ext = ext
-        image.save()
-        image.put_attachment(
-            data,
-            'file.%s' % ext,
-            content_length=getattr(data, 'size', None),
-        )
+        image.inline_attachment(data, 'file.%s' % ext)
+        if save:
+            failed = couch.bulk_save([image])
+            if failed:
+                node, error = failed[0]
+                raise ResourceConflict(error.get('reason'))
         self.image = image
 
+    def inline_attachment(self, content, name, content_type=None):
+        """Adds attachment to document itself, so it is saved together with
+        document."""
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0]
+        attachments = self._doc.setdefault('_attachments', {})
+        attachments[name] = {
+            'content_type': content_type or 'application/octet-stream',
+            'data': base64.b64encode(content),
+        }
+
+    def prepare_bulk_save(self):
+        """Called before node is saved using ``couch.bulk_save``."""
+        pass
+
+    def after_bulk_save(self):
+        """Called after node is saved using ``couch.bulk_save``."""
+        # Saved inline attachments are replaced with stubs, to not upload them
+        # again on next save.
+        for attachment in self._doc.get('_attachments', {}).values():
+            data = attachment.pop('data', None)
+            if data is not None:
+                attachment['stub'] = True
+                attachment['length'] = len(base64.b64decode(data))
+
 
     def get_permissions(self):
         if self._permissions is not None:
             return self._permissions
 
-        permissions = Permissions()
-        permissions.update(getRootNode().permissions)
-
-        for ancestor in self.get_ancestors():
-            permissions.update(ancestor.permissions)
+        permissions = compile_permissions(self.parents or [])
         permissions.update(self.permissions)
 
         self._permissions = permissions
@@ -573,7 +1312,14 @@ class BaseNode(schema.Document):
 
     def can(self, request, action, factory=None):
         permissions = self.get_permissions()
-        return permissions.can(request, action, factory)
+        return permissions.allows(request, action, factory)
+
+    def can_many(self, request, checks):
+        """Returns list of ``can`` results for each ``(action, factory)``
+        pair of ``checks``."""
+        permissions = self.get_permissions()
+        return [permissions.allows(request, action, factory)
+                for action, factory in checks]
 
     def before_save(self, form, node, create=False):
         """This method will be called before saving node.
@@ -590,9 +1336,36 @@ class BaseNode(schema.Document):
         """
         pass
 
+    def save(self, *args, **kwargs):
+        others = reconcile_slugs([self])
+        super(BaseNode, self).save(*args, **kwargs)
+        invalidate_view_cache()
+        invalidate_slugs([self])
+        node_post_save.send(sender=self)
+        # Conflicts are ignored, other writer has saved node already.
+        couch.bulk_save(others)
+
+    def put_attachment(self, *args, **kwargs):
+        result = super(BaseNode, self).put_attachment(*args, **kwargs)
+        # Attachment writes change ``_rev`` of cached documents.
+        invalidate_view_cache()
+        return result
+
+    def delete_attachment(self, *args, **kwargs):
+        result = super(BaseNode, self).delete_attachment(*args, **kwargs)
+        invalidate_view_cache()
+        return result
+
     def delete(self):
         node_pre_delete.send(sender=self)
+        others = reconcile_slugs([self], deleted=True)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(self._id)
         super(BaseNode, self).delete()
+        invalidate_view_cache()
+        invalidate_slugs([self])
+        couch.bulk_save(others)
 
 
 class Node(BaseNode):
@@ -601,6 +1374,12 @@ class Node(BaseNode):
     # Author, who initially created this node.
     author = schema.StringProperty()
 
+    # Body rendered to HTML at save time and key of markup settings, that were
+    # used for rendering. Rendered body is only used if markup settings did not
+    # change since then.
+    body_html = schema.StringProperty()
+    body_html_key = schema.StringProperty()
+
     def get_body(self):
         try:
             return self.fetch_attachment('body')
@@ -608,18 +1387,42 @@ class Node(BaseNode):
             return None
 
     def set_body(self, body, content_type='text/restructured'):
-        self.put_attachment(body, 'body', 'text/html')
+        """Saves node with new ``body`` and its rendered ``body_html``."""
+        self.body = body
+        self.save()
+
+    def set_body_html(self, body):
+        """Render ``body`` and store it in ``body_html``."""
+        self.body_html = markup.restructuredtext(body)
+        self.body_html_key = markup.get_settings_key()
 
     def save(self):
         body = self._doc.pop('body', None)
+        if body is not None:
+            self.set_body_html(body)
         super(Node, self).save()
         if body is not None:
-            self.set_body(body)
+            self.put_attachment(body, 'body', 'text/html')
+
+    def prepare_bulk_save(self):
+        body = self._doc.pop('body', None)
+        if body is not None:
+            self.set_body_html(body)
+            self.inline_attachment(body, 'body', 'text/html')
 
     def render_body(self):
+        """Returns ``body_html``.
+
+        Bodies of nodes, saved before ``body_html`` was introduced or with
+        other markup settings, are rendered on each call and are not stored,
+        ``sboard_render_bodies`` command must be run to store them.
+        """
         # TODO: only render content with restructuredtext if content type is
         # text/restructured
-        return markup.restructuredtext(self.get_body())
+        if (self.body_html is None or
+                self.body_html_key != markup.get_settings_key()):
+            self.set_body_html(self.get_body())
+        return mark_safe(self.body_html)
     render_body.is_safe = True
 
 
@@ -633,11 +1436,12 @@ provideNode(Root, "root")
 
 
 _root_node = None
+_root_node_id = '~'
 
 def getRootNode():
     global _root_node
     if _root_node is None:
-        key = '~'
+        key = _root_node_id
         try:
             _root_node = couch.get(key)
         except ResourceNotFound:
@@ -647,13 +1451,187 @@ def getRootNode():
     return _root_node
 
 
+def compile_permissions(parents):
+    """Returns permissions of root node merged with permissions of all
+    ``parents``.
+
+    Merged permissions table is cached for each chain of ancestors and
+    revisions of those ancestors, so all nodes with same ancestors share one
+    table, until one of ancestors is changed. Only current revisions of
+    ancestors are fetched, ancestors themselves are fetched only when table
+    is not cached yet.
+    """
+    chain = [_root_node_id] + [p for p in parents if p != _root_node_id]
+    revs = couch.get_revs(chain)
+    key = hashlib.md5(repr([(docid, revs.get(docid)) for docid in chain]))
+    key = 'sboard:permissions:%s' % key.hexdigest()
+
+    table = cache.get(key)
+    if table is None:
+        if _root_node_id not in revs:
+            # Root node is created on first access.
+            getRootNode()
+
+        permissions = Permissions()
+        ancestors = couch.get_many(chain)
+        for docid in chain:
+            if docid in ancestors:
+                permissions.update(ancestors[docid].permissions)
+        table = permissions.permissions
+        cache.set(key, table)
+
+    return Permissions(table)
+
+
 class Comment(Node):
     implements(IComment)
     _default_importance = 0
 
+    # ID of commented node, that is not a comment. All comments and replies
+    # to comments of one node have same thread.
+    thread = schema.StringProperty()
+
+    def set_parents(self, parent):
+        super(Comment, self).set_parents(parent)
+        if parent is None:
+            self.thread = None
+        elif isinstance(parent, Comment):
+            self.thread = parent.thread or parent.find_thread()
+        else:
+            self.thread = parent._id
+
+    def find_thread(self):
+        """Returns ID of nearest ancestor, that is not a comment, for comments
+        created before comment threads."""
+        ancestors = couch.get_many(self.parents)
+        for docid in reversed(self.parents):
+            if docid in ancestors and not isinstance(ancestors[docid],
+                                                     Comment):
+                return docid
+
+    def get_thread_key(self):
+        """Returns key of this comment in ``comment_threads`` view."""
+        if self.thread in self.parents:
+            start = self.parents.index(self.thread)
+        else:
+            start = -1
+        return self.parents[start:] + [self._id]
+
 provideNode(Comment, "comment")
 
 
+class CommentThread(object):
+    """Comment with list of replies, see ``get_comment_threads``."""
+
+    def __init__(self, comment, level):
+        self.comment = comment
+        self.level = level
+        self.replies = []
+        # Number of replies, that are deeper than requested depth.
+        self.hidden_replies = 0
+
+    def __iter__(self):
+        """Iterate over this thread and all replies, depth first."""
+        yield self
+        for reply in self.replies:
+            for thread in reply:
+                yield thread
+
+    def to_json(self):
+        comment = self.comment
+        return {
+            'id': comment._id,
+            'author': comment.author,
+            'created': comment.created.isoformat() if comment.created else None,
+            'body': comment.render_body(),
+            'url': comment.permalink(),
+            'replies': [reply.to_json() for reply in self.replies],
+            'hidden_replies': self.hidden_replies,
+        }
+
+
+def build_comment_threads(rows, prefix, depth):
+    """Builds list of ``CommentThread`` from ``comment_threads`` view rows,
+    queried without documents.
+
+    ``prefix`` is key of node, whose replies are in ``rows``. Only comments up
+    to ``depth`` levels are fetched, using one request, deeper replies are
+    only counted in ``hidden_replies`` of their ancestor at ``depth`` level.
+    """
+    prefix = len(prefix)
+    visible = [row['id'] for row in rows
+               if 0 < len(row['key']) - prefix <= depth]
+    comments = couch.get_many(visible)
+    threads = {}
+    top = []
+    for row in rows:
+        path = tuple(row['key'])
+        level = len(path) - prefix
+        if level < 1:
+            continue
+        elif level > depth:
+            ancestor = threads.get(path[:prefix + depth])
+            if ancestor is not None:
+                ancestor.hidden_replies += 1
+        elif row['id'] in comments:
+            thread = CommentThread(comments[row['id']], level)
+            threads[path] = thread
+            if level == 1:
+                top.append(thread)
+            elif path[:-1] in threads:
+                threads[path[:-1]].replies.append(thread)
+    return top
+
+
+def get_comment_thread_prefix(node):
+    """Returns key prefix of replies to ``node`` in ``comment_threads``
+    view."""
+    if isinstance(node, Comment):
+        return node.get_thread_key()
+    else:
+        return [node._id]
+
+
+def query_comment_threads(node, token=None, limit=10):
+    """Returns ``(page, rows)`` tuple, where ``page`` is ``Page`` of IDs of
+    newest top-level comments to ``node`` and ``rows`` are ``comment_threads``
+    view rows of these comments and all their replies, without documents.
+
+    ``token`` is page token, see ``couch.paginate``. If ``node`` is a comment,
+    then its replies are returned.
+    """
+    page = pagination.paginate(
+        functools.partial(couch.rows, 'sboard/comments'),
+        operator.itemgetter('id'), token=token, limit=limit,
+        startkey=[node._id, u'\ufff0'], endkey=[node._id], descending=True)
+    prefix = get_comment_thread_prefix(node)
+    queries = [dict(startkey=prefix + [docid], endkey=prefix + [docid, {}])
+               for docid in page]
+    rows = []
+    if queries:
+        results = couch.multi_query('sboard/comment_threads', queries)
+        for docid, result in zip(page, results):
+            if not result:
+                # Comment without thread, shown without replies until
+                # ``sboard_thread_comments`` is run.
+                result = [{'id': docid, 'key': prefix + [docid],
+                           'value': None}]
+            rows.extend(result)
+    return page, rows
+
+
+def get_comment_threads(node, depth=2, token=None, limit=10):
+    """Returns ``Page`` of ``CommentThread`` of newest comments to ``node``
+    with replies up to ``depth`` levels.
+
+    If ``node`` is a comment, then its replies are returned.
+    """
+    page, rows = query_comment_threads(node, token, limit)
+    threads = build_comment_threads(rows, get_comment_thread_prefix(node),
+                                    depth)
+    return pagination.Page(threads, page.next_token, page.previous_token)
+
+
 class History(Node):
     implements(IHistory)
 
@@ -666,7 +1644,7 @@ class History(Node):
     change = schema.StringProperty()
 
     @classmethod
-    def create(cls, node, change):
+    def create(cls, node, change, save=True):
         self = cls()
         self._id = self.get_new_id()
         if change in self.change_choices:
@@ -675,7 +1653,8 @@ class History(Node):
             raise KeyError("Change '%s' is not in change choices." % change)
         self.set_parents(node)
         self.node = dict(node)
-        self.save()
+        if save:
+            self.save()
         return self
 
     def render_body(self):
@@ -688,10 +1667,11 @@ class Tag(Node):
     implements(ITag)
 
     @classmethod
-    def create(cls, tag):
+    def create(cls, tag, save=True):
         self = cls()
         self._id = tag
-        self.save()
+        if save:
+            self.save()
         return self
 
     @classmethod
@@ -716,6 +1696,21 @@ class TagsChange(History):
 
 provideNode(TagsChange, "tags-change")
 
+
+# Size of chunks, used when storing files from attachments to file system.
+FILE_BUFFER_SIZE = 1024 * 1024
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Mode of files, written to temporary files and renamed, same as if they were
+# created with ``open``, so that web server can serve them.
+FILE_MODE = 0o666 & ~_get_umask()
+
+
 def get_file_node_cache_path(id,with_ext=True):
         """Returns the path to a previously cached file node. This method expects
         a symlink to cache extension data, allowing it to be used without
@@ -740,6 +1735,15 @@ class FileNode(Node):
 
     ext = schema.StringProperty(required=True)
 
+    def delete(self):
+        invalidate_normal_image(self._id)
+        super(FileNode, self).delete()
+
+    def put_attachment(self, *args, **kwargs):
+        result = super(FileNode, self).put_attachment(*args, **kwargs)
+        invalidate_normal_image(self._id)
+        return result
+
     def path(self, fetch=True):
         """Returns file path.
 
@@ -749,37 +1753,67 @@ class FileNode(Node):
 
         linkpath = get_file_node_cache_path(self._id, False)
         filepath = linkpath + "." + self.ext
-        dirpath = os.path.dirname(filepath)
 
         if not fetch:
             return filepath
 
-        if not os.path.exists(filepath):
-            if not os.path.exists(dirpath):
-                os.makedirs(dirpath)
-
-            stream = self.fetch_attachment('file.%s' % self.ext, stream=True)
-            f = open(filepath, 'wb')
-            while True:
-                chunk = stream.read(1024)
-                if chunk:
-                    f.write(chunk)
-                else:
-                    break
-            f.close()
-
-        if os.path.exists(linkpath):
-            linktarget = os.path.join(dirpath, os.readlink(linkpath))
-            if linktarget is not filepath:
-                os.unlink(linkpath)
-                os.symlink(filepath, linkpath)
-        else:
-            if not os.path.exists(dirpath):
-                os.makedirs(dirpath)
-            os.symlink(filepath, linkpath)
+        if not (os.path.exists(filepath) and os.path.lexists(linkpath)):
+            self.materialize(filepath, linkpath)
 
         return filepath
 
+    def store_attachment(self, filepath):
+        """Writes attachment to temporary file and renames it to
+        ``filepath``."""
+        stream = self.fetch_attachment('file.%s' % self.ext, stream=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                                       prefix='.tmp-')
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, FILE_BUFFER_SIZE)
+            os.rename(tmppath, filepath)
+        except:
+            os.unlink(tmppath)
+            raise
+
+    def materialize(self, filepath, linkpath):
+        """Stores attachment to ``filepath`` and points ``linkpath`` to it.
+
+        Only one process downloads same file at a time, others wait for it.
+        File is written to temporary file and renamed, so nobody sees half
+        written file.
+        """
+        dirpath = os.path.dirname(filepath)
+        if not os.path.exists(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                # Directory was created by other process.
+                pass
+
+        lockpath = filepath + '.lock'
+        with open(lockpath, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(filepath) and os.path.lexists(linkpath):
+                    # Other process already stored this file.
+                    return
+
+                # File can be already stored, if process crashed before
+                # creating link.
+                if not os.path.exists(filepath):
+                    self.store_attachment(filepath)
+
+                tmppath = os.path.join(dirpath, '.tmp-%s' % os.path.basename(
+                    linkpath))
+                if os.path.lexists(tmppath):
+                    os.unlink(tmppath)
+                os.symlink(os.path.basename(filepath), tmppath)
+                os.rename(tmppath, linkpath)
+                os.unlink(lockpath)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
 
 provideNode(FileNode, "file")
@@ -804,6 +1838,210 @@ class ImageNode(FileNode):
 provideNode(ImageNode, "image")
 
 
+# Maximum size of image, shown in ``media_normal_size`` url.
+NORMAL_IMAGE_SIZE = (724, 1024)
+
+# For how long information about rendered normal size image is cached.
+NORMAL_IMAGE_CACHE_TIMEOUT = 60 * 60
+
+
+def get_normal_image_dir():
+    return getattr(settings, 'SBOARD_NORMAL_IMAGE_DIR',
+                   os.path.join(settings.MEDIA_ROOT, 'normal'))
+
+
+def invalidate_normal_image(key):
+    cache.delete('sboard:normal-image:%s' % key)
+
+
+# For how long breadcrumbs of nodes, fetched by ``fetch_breadcrumbs``, are
+# cached.
+BREADCRUMB_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def fetch_breadcrumbs(docids):
+    """Returns dict of breadcrumbs of nodes by ``docids``.
+
+    Breadcrumbs are read from cache and only nodes missing there are fetched
+    using one ``_all_docs?keys=`` request.
+    """
+    keys = dict(('sboard:breadcrumb:%s' % docid, docid) for docid in docids)
+    crumbs = dict((keys[key], crumb)
+                  for key, crumb in cache.get_many(keys.keys()).items())
+    missing = [docid for docid in docids if docid not in crumbs]
+    if missing:
+        fetched = {}
+        for docid, node in couch.get_many(missing).items():
+            crumbs[docid] = fetched['sboard:breadcrumb:%s' % docid] = (
+                node.get_breadcrumb())
+        cache.set_many(fetched, BREADCRUMB_CACHE_TIMEOUT)
+    return crumbs
+
+
+def update_breadcrumbs(crumb):
+    """Replaces breadcrumb of node in all its descendants with given
+    ``crumb``, using bulk saves."""
+    for chunk in _iterchunks(couch.iterchunks(
+            'sboard/tree', startkey=[crumb['_id']],
+            endkey=[crumb['_id'], {}], include_docs=True,
+            rows_per_chunk=100), 100):
+        changed = []
+        for node in chunk:
+            crumbs = [dict(c) for c in node.breadcrumbs]
+            for i, c in enumerate(crumbs):
+                if c['_id'] == crumb['_id'] and c != crumb:
+                    crumbs[i] = crumb
+                    node.breadcrumbs = crumbs
+                    changed.append(node)
+                    break
+
+        # Retry nodes, that were changed meanwhile, once.
+        failed = [node for node, error in couch.bulk_save(changed)]
+        if failed:
+            retry = []
+            for node in couch.get_many(n._id for n in failed).values():
+                node.breadcrumbs = [crumb if c['_id'] == crumb['_id'] else c
+                                    for c in node.breadcrumbs]
+                retry.append(node)
+            couch.bulk_save(retry)
+
+
+def _iterchunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_breadcrumbs_pool = None
+_breadcrumbs_pool_lock = threading.Lock()
+
+
+def _update_breadcrumbs(crumb):
+    try:
+        update_breadcrumbs(crumb)
+    except Exception:
+        logger.exception('Failed to update breadcrumbs of node %s.',
+                         crumb['_id'])
+    finally:
+        close_old_connections()
+
+
+@receiver(node_post_save)
+def update_renamed_breadcrumbs(sender, **kwargs):
+    """Updates breadcrumbs of descendants of renamed node.
+
+    If ``SBOARD_BREADCRUMBS_ASYNC`` setting is True (default), descendants
+    are updated in one background thread, so updates are done in same order
+    as nodes were renamed.
+    """
+    global _breadcrumbs_pool
+    if not isinstance(sender, BaseNode):
+        return
+    crumb = sender.get_breadcrumb()
+    saved, sender._saved_breadcrumb = sender._saved_breadcrumb, crumb
+    if saved is None or saved == crumb:
+        return
+
+    cache.delete('sboard:breadcrumb:%s' % sender._id)
+    if not getattr(settings, 'SBOARD_BREADCRUMBS_ASYNC', True):
+        update_breadcrumbs(crumb)
+        return
+    with _breadcrumbs_pool_lock:
+        if _breadcrumbs_pool is None:
+            _breadcrumbs_pool = ThreadPool(1)
+    _breadcrumbs_pool.apply_async(_update_breadcrumbs, (crumb,))
+
+
+@receiver(node_post_save)
+def invalidate_saved_normal_image(sender, **kwargs):
+    if isinstance(sender, FileNode):
+        invalidate_normal_image(sender._id)
+
+
+def render_normal_image(node, path, ext):
+    """Resizes file of ``node`` to ``NORMAL_IMAGE_SIZE`` and stores it to
+    ``path``."""
+    infile = node.fetch_attachment('file.%s' % node.ext, stream=True)
+    image = PILImage.open(StringIO.StringIO(infile.read()))
+    image.thumbnail(NORMAL_IMAGE_SIZE, PILImage.ANTIALIAS)
+
+    extmap = {'jpg': 'jpeg'}
+    dirpath = os.path.dirname(path)
+    fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix='.tmp-')
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, extmap.get(ext, ext).upper())
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+
+def get_normal_image(key, ext):
+    """Returns dict with ``path``, ``etag`` and ``modified`` (timestamp) of
+    normal size image of file node ``key`` in ``ext`` format.
+
+    Rendered images are stored in ``SBOARD_NORMAL_IMAGE_DIR``, named by node
+    ID and digest of node file, so image is rendered only once for each file
+    revision. Information about current image is cached, so for cached
+    images neither CouchDB nor PIL are used. Returns None if node or file
+    does not exist.
+    """
+    cache_key = 'sboard:normal-image:%s' % key
+    images = cache.get(cache_key) or {}
+    image = images.get(ext)
+    if image is not None and os.path.exists(image['path']):
+        return image
+
+    try:
+        node = couch.get(key)
+    except ResourceNotFound:
+        return None
+    if not isinstance(node, FileNode):
+        return None
+    attachment = (node._attachments or {}).get('file.%s' % node.ext)
+    if attachment is None:
+        return None
+
+    revision = attachment.get('digest') or node._rev
+    etag = hashlib.md5('%s:%s:%dx%d:%s' % ((node._id, revision) +
+                                           NORMAL_IMAGE_SIZE + (ext,)))
+    etag = etag.hexdigest()
+
+    dirpath = os.path.join(get_normal_image_dir(), node._id[-2:])
+    path = os.path.join(dirpath, '%s-%s.%s' % (node._id, etag, ext))
+    if not os.path.exists(path):
+        if not os.path.exists(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                # Directory was created by other process.
+                pass
+        render_normal_image(node, path, ext)
+        # Remove images of old file revisions.
+        for oldpath in glob.glob(os.path.join(dirpath, '%s-*.%s' %
+                                              (node._id, ext))):
+            if oldpath != path:
+                try:
+                    os.unlink(oldpath)
+                except OSError:
+                    pass
+
+    images[ext] = image = {
+        'path': path,
+        'etag': etag,
+        'modified': int(os.path.getmtime(path)),
+    }
+    cache.set(cache_key, images, NORMAL_IMAGE_CACHE_TIMEOUT)
+    return image
+
+
 class CustomImage(Image):
     def run(self):
         media = get_node_by_slug(self.arguments[0])
@@ -824,17 +2062,46 @@ provideNode(Page, "page")
 
 
 def prefetch_nodes(attr, objects):
+    """Fetch all nodes referenced by ``attr`` of all ``objects`` at once.
+
+    ``attr`` can be a name of one ``NodeProperty`` attribute or a tuple of
+    names. ``objects`` can be a list of nodes or a tuple of lists. All
+    referenced nodes are fetched using one request and assigned back to
+    attributes, so accessing ``obj.attr.ref`` does not hit the database.
+    """
+    if isinstance(attr, basestring):
+        attrs = (attr,)
+    else:
+        attrs = tuple(attr)
+
     if not isinstance(objects, tuple):
         objects = (objects,)
 
     # Get all keys
-    keys, keymap = [], {}
+    keys, refs = [], []
     for obj in itertools.chain(*objects):
-        key = getattr(obj, attr)._id
-        keys.append(key)
-        keymap[key] = obj
+        for name in attrs:
+            ref = getattr(obj, name, None)
+            if ref:
+                keys.append(ref._id)
+                refs.append((obj, name, ref._id))
 
     # Get all nodes and assign to attributes.
-    for node in couch.view('_all_docs', keys=keys):
-        obj = keymap[node._id]
-        setattr(obj, attr, node)
+    nodes = couch.get_many(keys)
+    for obj, name, key in refs:
+        if key in nodes:
+            setattr(obj, name, nodes[key])
+
+
+def prefetch_children(nodes, latest=3):
+    """Fetch children counts and ``latest`` newest children of all ``nodes``
+    at once, so ``get_children_count`` and ``get_latest_children`` of these
+    nodes do not query the database."""
+    nodes = [node for node in nodes if node._id]
+    ids = [node._id for node in nodes]
+    counts = couch.children_counts(ids)
+    children = couch.latest_children(ids, latest) if latest else {}
+    for node in nodes:
+        node._children_count = counts[node._id]
+        if latest:
+            node._latest_children = children[node._id]
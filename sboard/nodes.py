@@ -1,10 +1,8 @@
-import re
-import unidecode
+import hashlib
 import os
 
 from zope.component import adapts
 from zope.component import getUtility
-from zope.component import provideAdapter
 from zope.interface import classImplements
 from zope.interface import implements
 
@@ -15,10 +13,12 @@ from django.shortcuts import render
 from django.utils.translation import ugettext_lazy as _
 
 from couchdbkit.client import ViewResults
+from couchdbkit.exceptions import ResourceConflict
 
 from .factory import INodeFactory
 from .factory import getNodeFactories
 from .factory import getNodeFactory
+from .factory import provideAdapter
 from .factory import provideViewExt
 from .forms import CommentForm
 from .forms import NodeForm
@@ -37,17 +37,27 @@ from .interfaces import IPage
 from .json import json_response
 from .models import BaseNode
 from .models import Node
-from .models import Tag
+from .models import NodeSummary
 from .models import TagsChange
 from .models import ImageNode
 from .models import couch
-from .models import set_nodes_ambiguous
+from .models import build_comment_threads
+from .models import get_comment_thread_prefix
+from .models import get_comment_threads
+from .models import prefetch_nodes
+from .models import query_comment_threads
+from .pagination import Page
+from .search import get_search_index
+from .search import get_search_terms
 from .utils import slugify
 
 
 _nodes_by_model = None
 
-search_words_re = re.compile(r'[^a-z]+')
+
+def make_etag(*parts):
+    """Returns ETag made of ``parts``."""
+    return hashlib.md5(repr(parts)).hexdigest()
 
 
 class BaseNodeView(object):
@@ -78,6 +88,21 @@ class BaseNodeView(object):
 
     template = None
 
+    # ``NodeProperty`` attributes of listed nodes, that should be fetched for
+    # whole list at once, for example ``('image',)``.
+    prefetch = ()
+
+    # If True, node lists contain ``NodeSummary`` objects with title, created,
+    # slug and ambiguous properties instead of nodes, unless ``prefetch`` is
+    # set. Set to True only if list template needs no other node properties.
+    summaries = False
+
+    # Number of nodes shown in one page of node list.
+    paginate_by = 50
+
+    # Name of GET parameter, that holds page token.
+    page_param = 'page'
+
     def __init__(self, node_or_factory=None):
         if isinstance(node_or_factory, BaseNode):
             self.node = node_or_factory
@@ -101,13 +126,73 @@ class BaseNodeView(object):
 
         return self.node.can(self.request, action, factory.name)
 
+    def can_many(self, checks):
+        """Returns list of ``can`` results for each ``(action, factory)``
+        pair of ``checks``, checked in one pass."""
+        results, node_checks = [], []
+        for action, factory in checks:
+            if factory is None:
+                factory = getNodeFactory("node")
+            if factory.has_child_permission(self.node, action):
+                results.append(None)
+                node_checks.append((action, factory.name))
+            else:
+                results.append(False)
+
+        allowed = iter(self.node.can_many(self.request, node_checks))
+        return [next(allowed) if result is None else result
+                for result in results]
+
+    def get_permission_tier(self):
+        """Returns string, that is same for all requests, that see same
+        navigation links of this node."""
+        checks = [('create', factory)
+                  for name, factory in sorted(getNodeFactories())]
+        checks += [('update', None), ('delete', None)]
+        allowed = self.can_many(checks) if self.node else []
+        return '%s:%s' % (self.request.user.pk or '',
+                          ''.join('1' if a else '0' for a in allowed))
+
+    def get_etag(self):
+        """Returns ETag of response, or None if response can't be validated
+        without rendering it."""
+        return None
+
+    def get_last_modified(self):
+        """Returns datetime, when response was last modified, or None."""
+        return None
+
     def get_node_list(self):
         if self.node:
             key = self.node._id
-            return couch.children_by_date(startkey=[key, 'Z'], endkey=[key],
-                                          descending=True, limit=50)
+            return self.paginate('sboard/children_by_date',
+                                 startkey=[key, 'Z'], endkey=[key],
+                                 descending=True)
         else:
-            return couch.all_nodes(descending=True, limit=50)
+            return self.paginate('sboard/all_nodes', descending=True)
+
+    def paginate(self, view, **kwargs):
+        """Returns page of nodes from ``view``, requested by page token in
+        current request."""
+        kwargs.setdefault('limit', self.paginate_by)
+        kwargs.setdefault('prefetch', self.prefetch)
+        kwargs.setdefault('summaries', self.summaries and not self.prefetch)
+        request = getattr(self, 'request', None)
+        token = request.GET.get(self.page_param) if request else None
+        return couch.paginate(view, token=token, **kwargs)
+
+    def get_page_links(self, page):
+        """Returns URLs of next and previous pages of given ``page``."""
+        links = {'next_page_url': None, 'previous_page_url': None}
+        request = getattr(self, 'request', None)
+        if isinstance(page, Page) and request is not None:
+            for name, token in (('next_page_url', page.next_token),
+                                ('previous_page_url', page.previous_token)):
+                if token is not None:
+                    query = request.GET.copy()
+                    query[self.page_param] = token
+                    links[name] = '?%s' % query.urlencode()
+        return links
 
     def get_form(self, *args, **kwargs):
         return self.form(self.node, *args, **kwargs)
@@ -120,11 +205,13 @@ class BaseNodeView(object):
             node = self.factory()
             node._id = node.get_new_id()
 
+        image = None
         if 'image' in data:
             image_data = data['image']
             filename, ext = os.path.splitext(image_data.name.lower())
             ext = ext[1:] # remove leading dot
-            node.set_image(image_data, ext)
+            node.set_image(image_data, ext, save=False)
+            image = node.image.ref
             image_data.close()
             del(data['image'])
 
@@ -145,7 +232,13 @@ class BaseNodeView(object):
             self.node.before_child_save(form, node, create=create)
 
         self.before_save(form, node, create=create)
-        node.save()
+        if image is None:
+            node.save()
+        else:
+            failed = couch.bulk_save([image, node])
+            if failed:
+                failed_node, error = failed[0]
+                raise ResourceConflict(error.get('reason'))
         return node
 
     def before_save(self, form, node, create):
@@ -154,8 +247,11 @@ class BaseNodeView(object):
     def get_create_links(self, active=tuple()):
         nav = []
         if self.node:
-            for name, factory in sorted(getNodeFactories()):
-                if self.can('create', factory):
+            factories = sorted(getNodeFactories())
+            allowed = self.can_many([('create', factory)
+                                     for name, factory in factories])
+            for (name, factory), can_create in zip(factories, allowed):
+                if can_create:
                     nav.append({
                         'key': name,
                         'url': self.node.permalink('create', name),
@@ -167,8 +263,11 @@ class BaseNodeView(object):
 
     def get_convert_to_links(self, active=tuple()):
         nav = []
-        for name, factory in getNodeFactories():
-            if self.can('create', factory):
+        factories = list(getNodeFactories())
+        allowed = self.can_many([('create', factory)
+                                 for name, factory in factories])
+        for (name, factory), can_create in zip(factories, allowed):
+            if can_create:
                 nav.append({
                     'key': name,
                     'url': self.node.permalink('convert', name),
@@ -181,6 +280,12 @@ class BaseNodeView(object):
     def nav(self, active=tuple()):
         nav = []
 
+        if self.node:
+            can_update, can_delete = self.can_many([('update', None),
+                                                    ('delete', None)])
+        else:
+            can_update = can_delete = False
+
         # Create
         create_links = self.get_create_links()
         if create_links:
@@ -194,7 +299,7 @@ class BaseNodeView(object):
             })
 
         # Edit
-        if self.node and self.can('update'):
+        if can_update:
             key = 'update'
             link = self.node.permalink('update')
             nav.append({
@@ -206,7 +311,7 @@ class BaseNodeView(object):
             })
 
         # Delete
-        if self.node and self.can('delete'):
+        if can_delete:
             key = 'delete'
             link = self.node.permalink('delete')
             nav.append({
@@ -259,8 +364,11 @@ class ListView(NodeView):
 
     template = 'sboard/node_list.html'
 
+    # ``sboard/node_list.html`` shows only titles and dates.
+    summaries = True
+
     def render(self, **overrides):
-        node_list = overrides.pop('node_list', self.get_node_list)
+        node_list = overrides.pop('node_list', self.get_shown_node_list)
         template = overrides.pop('template', self.template)
 
         if callable(node_list):
@@ -277,9 +385,32 @@ class ListView(NodeView):
             'node': self.node,
             'children': node_list,
         }
+        context.update(self.get_page_links(node_list))
         context.update(overrides or {})
         return render(self.request, template, context)
 
+    def get_shown_node_list(self):
+        """Returns ``get_node_list`` result, queried once per view."""
+        if not hasattr(self, '_node_list'):
+            self._node_list = self.get_node_list()
+        return self._node_list
+
+    def get_etag(self):
+        # Other node lists can show more, than nodes in the list.
+        if type(self).get_node_list != BaseNodeView.get_node_list:
+            return None
+        node_list = self.get_shown_node_list()
+        rows = []
+        for item in node_list:
+            if isinstance(item, NodeSummary):
+                rows.append((item._id, item.title, item.created, item.slug,
+                             item.ambiguous))
+            else:
+                rows.append((item._id, item._rev))
+        return make_etag(getattr(self.node, '_rev', None), rows,
+                         getattr(node_list, 'next_token', None),
+                         self.get_permission_tier())
+
 provideAdapter(ListView, (IRoot,))
 provideAdapter(ListView, name="list")
 
@@ -290,14 +421,11 @@ class SearchView(ListView):
         self.query = query
 
     def get_node_list(self):
-        qry = unidecode.unidecode(self.query)
-        qry = qry.lower()
-        qry = search_words_re.split(qry)
-        qry = filter(None, qry)
+        qry = get_search_terms(self.query)
         if len(qry):
             key = qry[0]
             args = dict(startkey=[key, 'Z'], endkey=[key])
-            return couch.search(descending=True, limit=50, **args)
+            return self.paginate('sboard/search', descending=True, **args)
         else:
             return []
 
@@ -309,24 +437,72 @@ class SearchView(ListView):
         return super(SearchView, self).render(**context)
 
 
+class IndexSearchView(SearchView):
+    """Search view, that finds nodes containing all query words in
+    ``sboard.search`` full text index."""
+
+    def __init__(self, query, index):
+        super(IndexSearchView, self).__init__(query)
+        self.index = index
+
+    def get_node_list(self):
+        request = getattr(self, 'request', None)
+        token = request.GET.get(self.page_param) if request else None
+        offset = int(token) if token and token.isdigit() else 0
+        limit = self.paginate_by
+
+        ids = self.index.search(get_search_terms(self.query), limit=limit + 1,
+                                offset=offset)
+        nodes = couch.get_many(ids[:limit])
+        nodes = [nodes[key] for key in ids[:limit] if key in nodes]
+        if self.prefetch:
+            prefetch_nodes(self.prefetch, nodes)
+
+        next_token = str(offset + limit) if len(ids) > limit else None
+        previous_token = str(max(offset - limit, 0)) if offset else None
+        return Page(nodes, next_token, previous_token)
+
+
+def index_search(query):
+    """Search handler for ``SBOARD_SEARCH_HANDLERS``, that uses full text
+    index, if ``SBOARD_SEARCH_INDEX`` is set."""
+    index = get_search_index()
+    if index is not None:
+        return IndexSearchView(query, index)
+
+
 class DetailsView(NodeView):
     template = 'sboard/node_details.html'
 
+    paginate_by = 10
+
+    # How many levels of replies to comments are shown.
+    comment_depth = 2
+
+    def get_comment_rows(self):
+        """Returns ``query_comment_threads`` result for requested page of
+        comments, queried once per view."""
+        if not hasattr(self, '_comment_rows'):
+            request = getattr(self, 'request', None)
+            token = request.GET.get(self.page_param) if request else None
+            self._comment_rows = query_comment_threads(self.node, token,
+                                                       self.paginate_by)
+        return self._comment_rows
+
     def render(self, **overrides):
-        # TODO: a hi-tech algorithm needed here, that can take all
-        # comment tree, two levels deep and display this tree in one
-        # cycle.
-        comments = couch.comments(startkey=[self.node._id, u'\ufff0'],
-                                  endkey=[self.node._id], descending=True,
-                                  include_docs=True, limit=10)
+        page, rows = self.get_comment_rows()
+        threads = build_comment_threads(
+            rows, get_comment_thread_prefix(self.node), self.comment_depth)
+        threads = Page(threads, page.next_token, page.previous_token)
         template = overrides.pop('template', self.template)
 
         context = {
             'title': self.node.title,
             'view': self,
             'node': self.node,
-            'comments': comments,
+            'comments': [comment for thread in threads for comment in thread],
         }
+        context.update(self.get_page_links(threads))
         context.update(overrides)
 
         if 'tag_form' not in context:
@@ -337,6 +513,13 @@ class DetailsView(NodeView):
 
         return render(self.request, template, context)
 
+    def get_etag(self):
+        # Comments are shown too, so their revisions are part of ETag.
+        page, rows = self.get_comment_rows()
+        comments = [(row['id'], row['value']) for row in rows]
+        return make_etag(self.node._rev, comments, page.next_token,
+                         self.get_permission_tier())
+
 provideAdapter(DetailsView)
 provideAdapter(DetailsView, name="details")
 
@@ -502,8 +685,10 @@ provideAdapter(CommentCreateView, (INode, IComment), name='create')
 class TagListView(ListView):
     adapts(INode)
 
+    paginate_by = 10
+
     def get_node_list(self):
-        return couch.by_tag(key=self.node._id, include_docs=True, limit=10)
+        return self.paginate('sboard/by_tag', key=self.node._id)
 
 provideAdapter(TagListView, name="tags")
 
@@ -517,11 +702,17 @@ class TagView(NodeView):
 
         form = TagForm(self.node, self.request.POST)
         if form.is_valid():
-            Tag.create_if_not_exists(form.cleaned_data['tag'])
-            history_node = TagsChange.create(self.node, 'tags-change')
-            self.node.tags.append(form.cleaned_data['tag'])
+            # Tag is an existing node, so only history and node are saved,
+            # both with one request.
+            key = form.cleaned_data['tag']._id
+            history_node = TagsChange.create(self.node, 'tags-change',
+                                             save=False)
+            self.node.tags.append(key)
             self.node.history = history_node._id
-            self.node.save()
+            failed = couch.bulk_save([history_node, self.node])
+            if failed:
+                node, error = failed[0]
+                raise ResourceConflict(error.get('reason'))
             return redirect(self.node.permalink())
         else:
             details = DetailsView(self.node)
@@ -549,7 +740,10 @@ class AmbiguousNodeView(ListView):
     adapts(IViewResults)
 
     def __init__(self, nodes):
-        set_nodes_ambiguous(nodes)
+        # Flags are fixed, when nodes are saved, here they are only set for
+        # links to be right.
+        for node in nodes:
+            node.ambiguous = True
         self.nodes = nodes
 
     def get_node_list(self):
@@ -563,6 +757,9 @@ class JsonView(BaseNodeView):
     implements(INodeJsonView)
     adapts(INode)
 
+    def get_etag(self):
+        return make_etag(self.node._rev)
+
     def render(self, **overrides):
         return json_response(self.node._doc)
 
@@ -570,6 +767,33 @@ provideAdapter(JsonView)
 provideViewExt(INodeJsonView, 'json')
 
 
+class CommentsJsonView(BaseNodeView):
+    """Returns page of comments of node or replies of comment as JSON tree,
+    for loading hidden replies. URL of next page is sent in ``Link``
+    header."""
+
+    implements(INodeJsonView)
+    adapts(INode)
+
+    paginate_by = 10
+
+    comment_depth = 2
+
+    def render(self, **overrides):
+        depth = self.request.GET.get('depth', '')
+        depth = int(depth) if depth.isdigit() else self.comment_depth
+        threads = get_comment_threads(
+            self.node, min(depth, 10), self.request.GET.get(self.page_param),
+            self.paginate_by)
+        response = json_response([thread.to_json() for thread in threads])
+        next_page_url = self.get_page_links(threads)['next_page_url']
+        if next_page_url:
+            response['Link'] = '<%s>; rel="next"' % next_page_url
+        return response
+
+provideAdapter(CommentsJsonView, name='comments')
+
+
 class DbView(BaseNodeView):
     implements(INodeDbView)
     adapts(INode)
@@ -0,0 +1,173 @@
+"""Keyset pagination of CouchDB views.
+
+Instead of skipping rows, each page starts from a key and document ID of a
+row, using ``startkey`` and ``startkey_docid`` view parameters, so fetching
+any page costs the same as fetching the first one.
+
+Position in a view is passed around as an opaque token, see ``encode_token``.
+
+"""
+
+from __future__ import absolute_import
+
+import base64
+import json
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_token(direction, row):
+    data = json.dumps([direction, row['key'], row['id']])
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_token(token):
+    """Returns (direction, key, docid) tuple or None if token is not valid."""
+    if not token:
+        return None
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, key, docid = json.loads(data)
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if direction not in (NEXT, PREVIOUS):
+        return None
+    return direction, key, docid
+
+
+class Page(object):
+    """One page of view results.
+
+    Iterating over page gives wrapped view rows. ``next_token`` and
+    ``previous_token`` are tokens of next and previous pages or None if there
+    is no such page.
+    """
+
+    def __init__(self, objects, next_token=None, previous_token=None):
+        self.objects = objects
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __nonzero__(self):
+        return bool(self.objects)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _type_rank(value):
+    if value is None:
+        return 0
+    elif isinstance(value, bool):
+        return 1
+    elif isinstance(value, (int, long, float)):
+        return 2
+    elif isinstance(value, basestring):
+        return 3
+    elif isinstance(value, (list, tuple)):
+        return 4
+    else:
+        return 5
+
+
+def collate(a, b):
+    """Compares two view keys in CouchDB view collation order.
+
+    Strings are compared by code points, that gives same order as CouchDB for
+    IDs and dates, used in view keys.
+    """
+    rank = _type_rank(a)
+    if rank != _type_rank(b):
+        return cmp(rank, _type_rank(b))
+    elif rank == 4:
+        for x, y in zip(a, b):
+            result = collate(x, y)
+            if result:
+                return result
+        return cmp(len(a), len(b))
+    elif rank == 5:
+        return 0
+    else:
+        return cmp(a, b)
+
+
+def in_range(key, startkey=None, endkey=None, descending=False, **kwargs):
+    """Returns True if ``key`` is between ``startkey`` and ``endkey``."""
+    sign = -1 if descending else 1
+    if startkey is not None and collate(key, startkey) * sign < 0:
+        return False
+    if endkey is not None and collate(key, endkey) * sign > 0:
+        return False
+    return True
+
+
+def _same_row(row, key, docid):
+    return row['key'] == key and row['id'] == docid
+
+
+def paginate(query, wrap, token=None, limit=50, **kwargs):
+    """Returns ``Page`` of ``query`` results.
+
+    ``query`` is a function, that takes view parameters and returns raw view
+    rows, ``wrap`` converts raw row to an object, that is shown in the page.
+    ``kwargs`` are view parameters, describing whole range of rows.
+    """
+    if 'key' in kwargs:
+        kwargs['startkey'] = kwargs['endkey'] = kwargs.pop('key')
+
+    # Token must not lead out of requested range, for example to other
+    # node's children.
+    position = decode_token(token)
+    if position is not None and not in_range(position[1], **kwargs):
+        position = None
+
+    if position is None or position[0] == NEXT:
+        params = dict(kwargs, limit=limit + 1)
+        if position is not None:
+            params['startkey'] = position[1]
+            params['startkey_docid'] = position[2]
+        rows = list(query(**params))
+
+        next_token = previous_token = None
+        if len(rows) > limit:
+            next_token = encode_token(NEXT, rows[limit])
+            rows = rows[:limit]
+        if position is not None and rows:
+            previous_token = encode_token(PREVIOUS, rows[0])
+
+    else:
+        # Walk view in opposite direction, starting from the first row of the
+        # page, that was shown before.
+        key, docid = position[1:]
+        params = dict(kwargs, limit=limit + 2, startkey=key,
+                      startkey_docid=docid,
+                      descending=not kwargs.get('descending', False))
+        params.pop('endkey', None)
+        if 'startkey' in kwargs:
+            params['endkey'] = kwargs['startkey']
+        rows = list(query(**params))
+        if rows and _same_row(rows[0], key, docid):
+            rows = rows[1:]
+
+        previous_token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            previous_token = encode_token(PREVIOUS, rows[-1])
+        rows.reverse()
+        next_token = encode_token(NEXT, {'key': key, 'id': docid})
+
+    return Page([wrap(row) for row in rows], next_token, previous_token)
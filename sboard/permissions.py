@@ -1,3 +1,12 @@
+def get_request_karma(request):
+    """Returns karma of authenticated request user. Profile is loaded once
+    per request."""
+    karma = getattr(request, '_sboard_karma', None)
+    if karma is None:
+        karma = request._sboard_karma = request.user.get_profile().karma
+    return karma
+
+
 class Permission(object):
     def __init__(self, request, action, name=None, value=None, node=None,
                  karma=None):
@@ -26,8 +35,7 @@ class Permission(object):
             # Only authenticated users with enough karma has permission.
             if self.value == 'authenticated':
                 if self.request.user.is_authenticated():
-                    profile = self.request.user.get_profile()
-                    return profile.karma >= self.karma
+                    return get_request_karma(self.request) >= self.karma
                 else:
                     return False
 
@@ -36,14 +44,23 @@ class Permission(object):
 
 
 class Permissions(object):
-    def __init__(self):
-        self.permissions = {}
+    def __init__(self, permissions=None):
+        self.permissions = dict(permissions or {})
+        self._signature = None
 
     def update(self, permissions):
         for row in permissions:
+            row = list(row)
             karma = row.pop()
             key = tuple(row)
             self.permissions[key] = karma
+        self._signature = None
+
+    def get_signature(self):
+        """Returns hashable value, same for all equal permission tables."""
+        if self._signature is None:
+            self._signature = frozenset(self.permissions.items())
+        return self._signature
 
     def get_keys(self, action, node):
         return [
@@ -73,3 +90,15 @@ class Permissions(object):
                 params.append(self.permissions[key])
                 return Permission(*params)
         return Permission(request, action, node=node)
+
+    def allows(self, request, action, node):
+        """Returns True if request user can do ``action``.
+
+        Decisions are remembered until the end of request, for each permission
+        table, action, node type and user.
+        """
+        decisions = request.__dict__.setdefault('_sboard_permissions', {})
+        key = (self.get_signature(), action, node, request.user.pk)
+        if key not in decisions:
+            decisions[key] = bool(self.can(request, action, node))
+        return decisions[key]
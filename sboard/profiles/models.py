@@ -18,6 +18,7 @@ from sboard.models import BaseNode
 from sboard.models import NodeForeignKey
 from sboard.models import NodeProperty
 from sboard.models import couch
+from sboard.models import get_image_node_thumbnail
 
 from .interfaces import IProfile
 from .interfaces import IGroup
@@ -61,20 +62,49 @@ class Profile(models.Model):
         return self.node.ref
 
 
+# User model fields, copied to profile node.
+USER_DATA_FIELDS = set(['username', 'email', 'first_name', 'last_name'])
+
+
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         # Create profile node instance
         node = ProfileNode()
         node._id = node.get_new_id()
         node.uid = instance.pk
+        node.set_user_data(instance)
         node.save()
 
         # Create profile model instance
         Profile.objects.create(user=instance, node=node._id)
+    else:
+        # Keep user data, copied to profile node, up to date. Saves like
+        # ``last_login`` update on each login are skipped.
+        update_fields = kwargs.get('update_fields')
+        if update_fields and not set(update_fields) & USER_DATA_FIELDS:
+            return
+        try:
+            profile = Profile.objects.get(user=instance)
+        except Profile.DoesNotExist:
+            return
+        node = profile.node.ref
+        if node.set_user_data(instance):
+            node.save()
 
 post_save.connect(create_user_profile, sender=settings.AUTH_USER_MODEL)
 
 
+GRAVATAR_URL = 'http://www.gravatar.com/avatar/%s?s=%s'
+
+
+def get_gravatar_hash(email):
+    email = (email or '').strip().lower()
+    if email:
+        return hashlib.md5(email.encode('utf-8')).hexdigest()
+    else:
+        return '0' * 32
+
+
 class ProfileNode(BaseNode):
     implements(IProfile)
 
@@ -87,6 +117,11 @@ class ProfileNode(BaseNode):
     dob = schema.StringProperty()
     home_page = schema.StringProperty()
 
+    # Copied from Django user, so that avatars can be shown without SQL
+    # queries. Updated when user is saved.
+    username = schema.StringProperty()
+    gravatar_hash = schema.StringProperty()
+
     def age(self):
         if not self.dob:
             return None
@@ -109,17 +144,35 @@ class ProfileNode(BaseNode):
     def user(self):
         return get_user_model().objects.get(pk=self.uid)
 
+    def set_user_data(self, user):
+        """Copies display data of Django ``user`` to this node. Returns True
+        if anything was changed."""
+        data = {
+            'username': user.get_username(),
+            'gravatar_hash': get_gravatar_hash(user.email),
+        }
+        if not self.first_name and not self.last_name:
+            data['first_name'] = user.first_name or None
+            data['last_name'] = user.last_name or None
+        if not self.title:
+            data['title'] = user.get_full_name() or user.get_username()
+
+        changed = False
+        for name, value in data.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        return changed
+
     def image_url(self, size=40):
         url = super(ProfileNode, self).image_url(size=size)
         if url:
             return url
-        elif self.user().email:
-            email = self.user().email.lower()
-            key = hashlib.md5(email).hexdigest()
-            return 'http://www.gravatar.com/avatar/%s?s=%s' % (key, size)
-        else:
-            key = '0' * 32
-            return 'http://www.gravatar.com/avatar/%s?s=%s' % (key, size)
+        gravatar_hash = self.gravatar_hash
+        if gravatar_hash is None:
+            # Profile node, not updated since gravatar hash was added.
+            gravatar_hash = get_gravatar_hash(self.user().email)
+        return GRAVATAR_URL % (gravatar_hash, size)
 
 provideNode(ProfileNode, "profile")
 
@@ -180,4 +233,43 @@ def query_profile_membership(profile_id):
 
 
 def query_profiles(profile_keys):
-    return couch.view('_all_docs', keys=profile_keys)
+    profiles = couch.get_many(profile_keys)
+    return [profiles[key] for key in profile_keys if key in profiles]
+
+
+def get_avatar_urls(profiles, size=40):
+    """Returns dict of avatar URLs of ``profiles`` by profile key.
+
+    Gravatar URLs are built from hashes stored in profile nodes and uploaded
+    images are read from file cache, so neither CouchDB nor SQL is queried.
+    Emails of old profile nodes without gravatar hash are read using one SQL
+    query.
+    """
+    geometry = '%dx%d' % (size, size)
+    urls, missing = {}, {}
+    for profile in profiles:
+        if profile.image:
+            urls[profile._id] = get_image_node_thumbnail(profile.image.key,
+                                                         geometry).url
+        elif profile.gravatar_hash is not None:
+            urls[profile._id] = GRAVATAR_URL % (profile.gravatar_hash, size)
+        else:
+            missing[profile.uid] = profile._id
+
+    if missing:
+        users = get_user_model().objects.filter(pk__in=missing.keys())
+        emails = dict(users.values_list('pk', 'email'))
+        for uid, key in missing.items():
+            urls[key] = GRAVATAR_URL % (get_gravatar_hash(emails.get(uid)),
+                                        size)
+    return urls
+
+
+def query_profile_avatars(profile_keys, size=40):
+    """Returns list of ``(profile, avatar_url)`` tuples of given profile keys.
+
+    Profiles are fetched using one CouchDB request.
+    """
+    profiles = query_profiles(profile_keys)
+    urls = get_avatar_urls(profiles, size)
+    return [(profile, urls[profile._id]) for profile in profiles]
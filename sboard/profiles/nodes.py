@@ -1,8 +1,8 @@
 from zope.component import adapts
-from zope.component import provideAdapter
 
 from django.shortcuts import render
 
+from sboard.factory import provideAdapter
 from sboard.nodes import ListView
 from sboard.nodes import NodeView
 from sboard.nodes import UpdateView
@@ -10,6 +10,7 @@ from sboard.nodes import UpdateView
 from .forms import ProfileForm
 from .interfaces import IGroup
 from .interfaces import IProfile
+from .models import get_avatar_urls
 from .models import query_group_membership
 
 
@@ -45,4 +46,12 @@ class GroupView(ListView):
     def get_node_list(self):
         return query_group_membership(self.node._id)
 
+    def render(self, **overrides):
+        memberships = list(overrides.pop('node_list', self.get_node_list()))
+        avatars = get_avatar_urls([m.profile.ref for m in memberships])
+        members = [(m, avatars.get(m.profile.key)) for m in memberships]
+        overrides.setdefault('members', members)
+        return super(GroupView, self).render(node_list=memberships,
+                                             **overrides)
+
 provideAdapter(GroupView)
@@ -0,0 +1,167 @@
+"""Full text search index of nodes.
+
+Index is stored in SQLite FTS5 table in a file set by ``SBOARD_SEARCH_INDEX``
+setting. If setting is not set, nodes are not indexed and ``index_search``
+search handler does nothing.
+
+Title, summary, keywords and body of each node with ``importance`` above zero
+are indexed, when node is saved.
+
+"""
+
+from __future__ import absolute_import
+
+import calendar
+import re
+import sqlite3
+import threading
+import time
+
+import unidecode
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.utils.html import strip_tags
+
+from .models import BaseNode
+from .models import node_post_save
+from .models import node_pre_delete
+
+search_words_re = re.compile(r'[^a-z0-9]+')
+
+# Weights of title, summary, keywords and body, when ranking by term frequency.
+COLUMN_WEIGHTS = (10.0, 5.0, 5.0, 1.0)
+
+# Nodes, that are this much seconds old, have half of rank of new nodes.
+RECENCY_HALF_LIFE = 365 * 24 * 60 * 60
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS node_ids (
+        rowid INTEGER PRIMARY KEY,
+        node_id TEXT NOT NULL UNIQUE
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS node_search USING fts5 (
+        title, summary, keywords, body,
+        importance UNINDEXED, created UNINDEXED
+    );
+"""
+
+# bm25() gives negative numbers, lower is better, so multiplying it by
+# importance and recency factors keeps order right.
+SEARCH_QUERY = """
+    SELECT node_ids.node_id
+    FROM node_search JOIN node_ids ON node_ids.rowid = node_search.rowid
+    WHERE node_search MATCH ?
+    ORDER BY bm25(node_search, %s, 0, 0)
+             * (1 + node_search.importance / 10.0)
+             / (1 + max(? - node_search.created, 0) / ?)
+    LIMIT ? OFFSET ?
+""" % ', '.join(map(str, COLUMN_WEIGHTS))
+
+
+def normalize(text):
+    return unidecode.unidecode(text or u'').lower()
+
+
+def get_search_terms(query):
+    """Returns list of normalized words from search ``query``."""
+    return filter(None, search_words_re.split(normalize(query)))
+
+
+class SearchIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _delete(self, cursor, node_id):
+        cursor.execute('SELECT rowid FROM node_ids WHERE node_id = ?',
+                       (node_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute('DELETE FROM node_search WHERE rowid = ?', row)
+            cursor.execute('DELETE FROM node_ids WHERE rowid = ?', row)
+
+    def _add(self, cursor, node):
+        self._delete(cursor, node._id)
+        if not node.importance or node.importance <= 0:
+            return
+
+        cursor.execute('INSERT INTO node_ids (node_id) VALUES (?)',
+                       (node._id,))
+        created = node.created
+        if created is not None:
+            created = calendar.timegm(created.utctimetuple())
+        cursor.execute(
+            'INSERT INTO node_search (rowid, title, summary, keywords, body, '
+            '                         importance, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                cursor.lastrowid,
+                normalize(node.title),
+                normalize(node.summary),
+                normalize(u' '.join(node.keywords or [])),
+                normalize(strip_tags(node._doc.get('body_html') or u'')),
+                node.importance,
+                created or 0,
+            ))
+
+    def update(self, nodes):
+        """Adds or replaces ``nodes`` in index in one transaction."""
+        with self.connection as connection:
+            cursor = connection.cursor()
+            for node in nodes:
+                self._add(cursor, node)
+
+    def delete(self, node_id):
+        with self.connection as connection:
+            self._delete(connection.cursor(), node_id)
+
+    def clear(self):
+        with self.connection as connection:
+            connection.execute('DELETE FROM node_search')
+            connection.execute('DELETE FROM node_ids')
+
+    def search(self, terms, limit=50, offset=0):
+        """Returns list of IDs of nodes, that contain all ``terms``, best
+        matches first."""
+        if not terms:
+            return []
+        match = u' AND '.join(u'"%s"' % term for term in terms)
+        cursor = self.connection.execute(SEARCH_QUERY, (
+            match, time.time(), RECENCY_HALF_LIFE, limit, offset))
+        return [node_id for node_id, in cursor]
+
+
+_search_index = None
+
+def get_search_index():
+    """Returns ``SearchIndex`` or None if ``SBOARD_SEARCH_INDEX`` is not set."""
+    global _search_index
+    path = getattr(settings, 'SBOARD_SEARCH_INDEX', None)
+    if not path:
+        return None
+    if _search_index is None or _search_index.path != path:
+        _search_index = SearchIndex(path)
+    return _search_index
+
+
+@receiver(node_post_save)
+def index_node(sender, **kwargs):
+    index = get_search_index()
+    if index is not None and isinstance(sender, BaseNode):
+        index.update([sender])
+
+
+@receiver(node_pre_delete)
+def unindex_node(sender, **kwargs):
+    index = get_search_index()
+    if index is not None:
+        index.delete(sender._id)
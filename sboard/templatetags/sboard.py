@@ -1,10 +1,23 @@
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
 from django import template
+from django.conf import settings
 from django.core.cache import cache
+from django.db import close_old_connections
 
 from cgi import escape
 
 from sorl.thumbnail.templatetags.thumbnail import margin
 
+from sboard.models import couch
+
+logger = logging.getLogger(__name__)
+
 register = template.Library()
 
 
@@ -30,45 +43,232 @@ SIZES = {
     'large': 135,
 }
 
-@register.simple_tag
-def nodeimage(node, size='normal', additional_classes=''):
-    if not node:
-        return ''
-    key = ':'.join(['nodeimage', node._id, unicode(size), additional_classes])
+# For how long rendered node image tags are cached.
+NODEIMAGE_CACHE_TIMEOUT = 24 * 60 * 60
 
-    value = cache.get(key)
+# Shown instead of thumbnail, until thumbnail is generated.
+NODEIMAGE_PLACEHOLDER = ('data:image/gif;base64,'
+                         'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
 
-    if value:
-        return value
+# Number of threads generating thumbnails in background.
+NODEIMAGE_WORKERS = 2
+
+# Context variable, where image tags prefetched by ``nodeimages`` are stored.
+NODEIMAGES_CONTEXT_KEY = '_sboard_nodeimages'
+
+# Request attribute, set when placeholder is rendered instead of thumbnail.
+NODEIMAGE_PLACEHOLDER_SHOWN = '_sboard_nodeimage_placeholder'
+
+
+def get_nodeimage_cache_key(node, image_rev, size, additional_classes):
+    """Cache key of node image tag.
+
+    Key contains revisions of node and its image, so changed title or replaced
+    image get new key and old tag is never shown.
+    """
+    return 'sboard:nodeimage:%s:%s:%s:%s:%s' % (
+        node._id, getattr(node, '_rev', None), image_rev, size,
+        additional_classes.replace(' ', '.'))
+
+
+def render_nodeimage(node, size='normal', additional_classes='', image=None):
+    """Renders ``<img>`` tag of ``node``.
+
+    If node has an image, then thumbnail of given ``image`` node is shown. If
+    ``image`` is None, placeholder of the same size is shown instead.
+    """
+    if size in SIZES:
+        html_class = 'node-image-%s' % size
+        size = SIZES[size]
     else:
-        if size in SIZES:
-            html_class = 'node-image-%s' % size
-            size = SIZES[size]
-        else:
-            html_class = 'node-image'
+        html_class = 'node-image'
+        size = int(size)
 
-        if additional_classes:
-            html_class += ' ' + additional_classes
+    if additional_classes:
+        html_class += ' ' + additional_classes
 
-        attrs = {
-            'alt': node.title,
-            'class': html_class,
-        }
+    attrs = {
+        'alt': node.title,
+        'class': html_class,
+    }
 
-        if node.image:
-            geometry = '%dx%d' % (size, size)
-            thumbnail = node.image.ref.thumbnail(geometry)
-            attrs['src'] = thumbnail.url
-            attrs['style'] = 'padding:%s' % margin(thumbnail, geometry)
-        else:
-            attrs['src'] = node.image_url(size=size)
+    if node.image and image is not None:
+        geometry = '%dx%d' % (size, size)
+        thumbnail = image.thumbnail(geometry)
+        attrs['src'] = thumbnail.url
+        attrs['style'] = 'padding:%s' % margin(thumbnail, geometry)
+    elif node.image:
+        attrs['src'] = NODEIMAGE_PLACEHOLDER
+        attrs['width'] = attrs['height'] = str(size)
+    else:
+        attrs['src'] = node.image_url(size=size)
 
-        if attrs['src']:
-            attr_string = u' '.join(u'%s="%s"' % (name, escape(value)) for name, value in attrs.items() if value)
-            value = u'<img %s>' % attr_string
-        else:
-            value = ''
+    if attrs['src']:
+        attr_string = u' '.join(u'%s="%s"' % (name, escape(value))
+                                for name, value in sorted(attrs.items())
+                                if value)
+        return u'<img %s>' % attr_string
+    else:
+        return u''
+
+
+_pool = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _generate_nodeimage(key, node_id, size, additional_classes):
+    try:
+        node = couch.get(node_id)
+        value = render_nodeimage(node, size, additional_classes,
+                                 node.image.ref if node.image else None)
+        cache.set(key, value, NODEIMAGE_CACHE_TIMEOUT)
+    except Exception:
+        logger.exception('Failed to generate image of node %s.', node_id)
+    finally:
+        with _pending_lock:
+            _pending.discard(key)
+        close_old_connections()
 
-        cache.set(key, value)
+
+def generate_nodeimage(key, node, size, additional_classes):
+    """Generates thumbnail of ``node`` image and caches its tag under ``key``.
+
+    If ``SBOARD_NODEIMAGE_ASYNC`` setting is True (default), thumbnail is
+    generated in background thread and each key is generated only once at a
+    time. Returns rendered tag or None if it is generated in background.
+    """
+    if not getattr(settings, 'SBOARD_NODEIMAGE_ASYNC', True):
+        value = render_nodeimage(node, size, additional_classes,
+                                 node.image.ref)
+        cache.set(key, value, NODEIMAGE_CACHE_TIMEOUT)
         return value
 
+    global _pool
+    with _pending_lock:
+        if key in _pending:
+            return None
+        _pending.add(key)
+        if _pool is None:
+            _pool = ThreadPool(NODEIMAGE_WORKERS)
+    _pool.apply_async(_generate_nodeimage,
+                      (key, node._id, size, additional_classes))
+    return None
+
+
+def get_node_images(nodes, size='normal', additional_classes=''):
+    """Returns dict of rendered image tags of ``nodes`` by node ID.
+
+    Revisions of not fetched image nodes are read using one
+    ``_all_docs?keys=`` request and all tags are fetched from cache using one
+    ``cache.get_many`` call. Missing thumbnails are shown as placeholders,
+    until they are generated.
+    """
+    nodes = [node for node in nodes if node]
+
+    image_revs, missing = {}, set()
+    for node in nodes:
+        if node.image is None:
+            continue
+        if node.image._node is not None:
+            image_revs[node.image.key] = node.image._node._rev
+        else:
+            missing.add(node.image.key)
+    if missing:
+        image_revs.update(couch.get_revs(missing))
+
+    keys = {}
+    for node in nodes:
+        image_rev = image_revs.get(node.image.key) if node.image else None
+        keys[node._id] = get_nodeimage_cache_key(node, image_rev, size,
+                                                 additional_classes)
+
+    images = cache.get_many(keys.values())
+    values, rendered = {}, {}
+    for node in nodes:
+        key = keys[node._id]
+        value = images.get(key)
+        if value is None and node.image and node.image.key in image_revs:
+            value = generate_nodeimage(key, node, size, additional_classes)
+            if value is None:
+                value = render_nodeimage(node, size, additional_classes)
+        elif value is None:
+            # Node without image or with deleted image node.
+            value = rendered[key] = render_nodeimage(node, size,
+                                                     additional_classes)
+        values[node._id] = value
+
+    if rendered:
+        cache.set_many(rendered, NODEIMAGE_CACHE_TIMEOUT)
+    return values
+
+
+def mark_placeholders(context, values):
+    """Marks request of ``context``, if any of rendered image tags
+    ``values`` is a placeholder, so that response is not validated by ETag,
+    which does not change when thumbnail is generated."""
+    request = context.get('request')
+    if request is None:
+        return
+    if any(NODEIMAGE_PLACEHOLDER in value for value in values):
+        setattr(request, NODEIMAGE_PLACEHOLDER_SHOWN, True)
+
+
+@register.simple_tag(takes_context=True)
+def nodeimage(context, node, size='normal', additional_classes=''):
+    if not node:
+        return ''
+    images = context.get(NODEIMAGES_CONTEXT_KEY, {})
+    value = images.get((node._id, unicode(size), additional_classes))
+    if value is None:
+        value = get_node_images([node], size, additional_classes)[node._id]
+    mark_placeholders(context, [value])
+    return value
+
+
+class NodeImagesNode(template.Node):
+    def __init__(self, nodes, size, additional_classes, nodelist):
+        self.nodes = nodes
+        self.size = size
+        self.additional_classes = additional_classes
+        self.nodelist = nodelist
+
+    def render(self, context):
+        nodes = self.nodes.resolve(context) or []
+        size = unicode(self.size.resolve(context) if self.size else 'normal')
+        additional_classes = (self.additional_classes.resolve(context)
+                              if self.additional_classes else '')
+
+        images = dict(context.get(NODEIMAGES_CONTEXT_KEY, {}))
+        values = get_node_images(nodes, size, additional_classes)
+        for node_id, value in values.items():
+            images[(node_id, size, additional_classes)] = value
+        mark_placeholders(context, values.values())
+
+        context.update({NODEIMAGES_CONTEXT_KEY: images})
+        try:
+            return self.nodelist.render(context)
+        finally:
+            context.pop()
+
+
+@register.tag
+def nodeimages(parser, token):
+    """Prefetches image tags of all given nodes, so that ``nodeimage`` tags
+    inside the block do not touch cache or database::
+
+        {% nodeimages nodes 'small' %}
+          {% for node in nodes %}{% nodeimage node 'small' %}{% endfor %}
+        {% endnodeimages %}
+
+    """
+    bits = token.split_contents()
+    if not 2 <= len(bits) <= 4:
+        raise template.TemplateSyntaxError(
+            "'%s' tag takes nodes, size and additional classes arguments."
+            % bits[0])
+    args = [parser.compile_filter(bit) for bit in bits[1:]]
+    args += [None] * (3 - len(args))
+    nodelist = parser.parse(('endnodeimages',))
+    parser.delete_first_token()
+    return NodeImagesNode(*(args + [nodelist]))
@@ -1,27 +1,91 @@
+# coding: utf-8
+from __future__ import absolute_import
+
 import StringIO
+import datetime
+import json
 import os.path
 import shutil
+import time
 import unittest
 
+from mock import Mock
 from mock import patch
 
+from zope.component import ComponentLookupError
+from zope.component import adapts
+from zope.component import getSiteManager
+
+from PIL import Image as PILImage
+
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 from django.db.models import get_app
+from django.http import HttpResponse
+from django.template import Context
+from django.template import Template
 from django.test import TestCase
+from django.test.client import RequestFactory
 
 from couchdbkit.exceptions import ResourceNotFound
 from couchdbkit.ext.django import loading
 
+from .factory import provideAdapter
 from .factory import provideNode
+from .interfaces import INode
+from .interfaces import IViewResults
+from .categories.models import get_tree
+from .categories.models import query_tree
 from .models import BaseNode
+from .models import Comment
+from .models import FILE_MODE
 from .models import FileNode
+from .models import ImageNode
+from .models import KeyAllocator
 from .models import Node
 from .models import NodeProperty
+from .models import NodeSummary
 from .models import UniqueKey
+from .models import view_cache_stats
+from .models import compile_permissions
+from .models import activate_identity_map
 from .models import couch
+from .models import deactivate_identity_map
+from .models import get_comment_threads
+from .models import get_file_node_cache_path
+from .models import get_key_high_water
+from .models import get_new_ids
+from .models import get_node_by_slug
+from .models import get_normal_image
+from .models import invalidate_normal_image
+from .models import prefetch_children
+from .models import prefetch_nodes
+from .nodes import CreateView
+from .nodes import DetailsView
+from .nodes import JsonView
+from .nodes import ListView
+from .nodes import NodeView
+from .pagination import NEXT
+from .pagination import PREVIOUS
+from .pagination import encode_token
+from .pagination import in_range
+from .pagination import paginate
+from .permissions import Permissions
 from .profiles.models import Profile
+from .profiles.models import get_gravatar_hash
+from .profiles.models import query_profile_avatars
+from .search import SearchIndex
+from .search import get_search_terms
+from .templatetags.sboard import NODEIMAGE_PLACEHOLDER
+from .templatetags.sboard import get_node_images
+from .utils import base36
+from .views import _lookup_node_view
+from .views import clear_view_dispatch_cache
+from .views import get_node_view
+from .views import render_conditional
 
 
 class NodesTestsMixin(object):
@@ -229,6 +293,742 @@ class TestFilePath(unittest.TestCase):
         with open(path) as f:
             self.assertEqual(f.read(), 'content')
 
+        # Only stored file and link to it are left in directory.
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         ['0001', '0001.txt'])
+        self.assertEqual(get_file_node_cache_path('000123'), path)
+
+        # Stored file is not fetched again.
+        fetch_attachment.reset_mock()
+        self.assertEqual(node.path(), path)
+        self.assertFalse(fetch_attachment.called)
+
+        # Stored file has same mode as files created with open().
+        self.assertEqual(os.stat(path).st_mode & 0o777, FILE_MODE)
+
+        # Missing link is created again, without fetching file.
+        os.unlink(os.path.join(os.path.dirname(path), '0001'))
+        self.assertEqual(node.path(), path)
+        self.assertFalse(fetch_attachment.called)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         ['0001', '0001.txt'])
+
+
+class TestBulkSave(NodesTestsMixin, TestCase):
+    def test_bulk_save(self):
+        nodes = [Node(title=u'Node %d' % i) for i in range(5)]
+        nodes[0].body = u'*Body*'
+        self.assertEqual(couch.bulk_save(nodes, batch_size=2), [])
+        for node in nodes:
+            self.assertTrue(node._id)
+            self.assertTrue(node._rev.startswith('1-'))
+
+        node = Node.get(nodes[0]._id)
+        self.assertEqual(node.get_body(), u'*Body*')
+        self.assertIn('<em>Body</em>', node.body_html)
+
+        # Saving node with old revision fails with conflict.
+        stale = Node.get(nodes[1]._id)
+        nodes[1].title = u'Changed'
+        stale.title = u'Stale'
+        failed = couch.bulk_save([nodes[1], stale, nodes[2]])
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0][0], stale)
+        self.assertEqual(failed[0][1]['error'], 'conflict')
+        self.assertTrue(nodes[1]._rev.startswith('2-'))
+        self.assertEqual(Node.get(nodes[1]._id).title, u'Changed')
+
+
+class TestConditionalGet(NodesTestsMixin, TestCase):
+    def test_node_details(self):
+        node = Node(_id='000001', title=u'Node')
+        node.save()
+        url = reverse('node', args=['000001'])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Cookie', response['Vary'])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # New comment changes ETag.
+        comment = Comment(title=u'Comment')
+        comment.set_parent(node)
+        comment.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # Navigation links differ for logged in users.
+        etag = response['ETag']
+        self._login_superuser()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_json(self):
+        node = Node(_id='000001', title=u'Node')
+        node.save()
+        url = reverse('node_ext', args=['000001', 'json'])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        node.title = u'Changed'
+        node.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_node_list(self):
+        parent = Node(_id='000001', title=u'Parent')
+        parent.save()
+        older = Node(title=u'Older', created=datetime.datetime(2013, 1, 1))
+        older.set_parent(parent)
+        older.save()
+        child = Node(title=u'Child', created=datetime.datetime(2013, 1, 2))
+        child.set_parent(parent)
+        child.save()
+        url = reverse('node', args=['000001', 'list'])
+
+        with patch.object(couch, 'rows', wraps=couch.rows) as rows:
+            response = self.client.get(url)
+        views = [call[0][0] for call in rows.call_args_list]
+        self.assertEqual(views.count('sboard/children_by_date'), 1)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Renaming node, that is not the newest, changes ETag.
+        older.title = u'Renamed'
+        older.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, u'Renamed')
+        etag = response['ETag']
+
+        older.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, u'Renamed')
+
+
+class TestTagView(NodesTestsMixin, TestCase):
+    def test_tag(self):
+        tag = Node(_id='000001', title=u'Tag')
+        tag.save()
+        node = Node(_id='000002', title=u'Node')
+        node.save()
+        self._login_superuser()
+        url = reverse('node', args=['000002', 'tag'])
+
+        # Existing tag node is not saved again, history and node are saved
+        # with one request.
+        with patch.object(couch, 'bulk_save',
+                          wraps=couch.bulk_save) as bulk_save:
+            response = self.client.post(url, {'tag': '000001'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(bulk_save.call_count, 1)
+        self.assertEqual(len(bulk_save.call_args[0][0]), 2)
+        node = couch.get('000002')
+        self.assertEqual(node.tags, ['000001'])
+        self.assertEqual(couch.get('000001')._rev, tag._rev)
+
+
+class TestViewCache(NodesTestsMixin, TestCase):
+    def test_view_cache(self):
+        with patch.object(settings, 'SBOARD_VIEW_CACHE',
+                          {'sboard/children': 60}, create=True):
+            self.check_view_cache()
+
+    def check_view_cache(self):
+        view_cache_stats.clear()
+        parent = Node(_id='000001', title=u'Parent')
+        parent.save()
+
+        def children():
+            return [row['id'] for row in couch.rows('sboard/children',
+                                                    key='000001')]
+
+        self.assertEqual(children(), [])
+        self.assertEqual(children(), [])
+        self.assertEqual(view_cache_stats['sboard/children'],
+                         {'hits': 1, 'misses': 1})
+
+        # Any write invalidates cached results.
+        child = Node(_id='000002', title=u'Child')
+        child.set_parent(parent)
+        child.save()
+        self.assertEqual(children(), ['000002'])
+        self.assertEqual([node._id for node in couch.children(key='000001')],
+                         ['000002'])
+        self.assertEqual(view_cache_stats['sboard/children'],
+                         {'hits': 1, 'misses': 3})
+
+        # Not listed views are not cached.
+        list(couch.rows('sboard/all_nodes'))
+        self.assertNotIn('sboard/all_nodes', view_cache_stats)
+
+    def test_attachment_write(self):
+        with patch.object(settings, 'SBOARD_VIEW_CACHE',
+                          {'sboard/children': 60}, create=True):
+            parent = Node(_id='000001', title=u'Parent')
+            parent.save()
+            child = Node(_id='000002', title=u'Child')
+            child.set_parent(parent)
+            child.save()
+
+            node = couch.children(key='000001').first()
+            node.put_attachment(u'Body', 'body', 'text/html')
+
+            # Cached rows have revision written by ``put_attachment``.
+            node = couch.children(key='000001').first()
+            self.assertEqual(node._rev, couch.get('000002')._rev)
+            node.title = u'Changed'
+            node.save()
+
+
+class TestBreadcrumbs(NodesTestsMixin, TestCase):
+    @patch.object(settings, 'SBOARD_BREADCRUMBS_ASYNC', False, create=True)
+    def test_breadcrumbs(self):
+        a = Node(_id='00000a', title=u'A', slug='a')
+        a.save()
+        b = Node(_id='00000b', title=u'B')
+        b.set_parent(a)
+        b.save()
+        c = Node(_id='00000c', title=u'C')
+        c.set_parent(b)
+        c.save()
+
+        with patch.object(couch, 'get_many') as get_many:
+            crumbs = c.get_breadcrumbs()
+            self.assertFalse(get_many.called)
+        self.assertEqual([(n._id, n.title) for n in crumbs],
+                         [('00000a', u'A'), ('00000b', u'B')])
+        self.assertEqual(crumbs[0].permalink(), '/a/')
+
+        # Renamed ancestor is updated in all descendants.
+        a = couch.get('00000a')
+        a.title = u'Renamed'
+        a.save()
+        c = couch.get('00000c')
+        self.assertEqual([n.title for n in c.get_breadcrumbs()],
+                         [u'Renamed', u'B'])
+        self.assertEqual([n._id for n in c.get_ancestors()],
+                         ['00000a', '00000b'])
+
+        # Missing breadcrumbs are fetched.
+        del c.breadcrumbs[:]
+        self.assertEqual([n.title for n in c.get_breadcrumbs()],
+                         [u'Renamed', u'B'])
+        with patch.object(couch, 'get_many') as get_many:
+            self.assertEqual(len(c.get_breadcrumbs()), 2)
+            self.assertFalse(get_many.called)
+
+
+class TestSlugCache(NodesTestsMixin, TestCase):
+    def test_slug_cache(self):
+        cache.clear()
+        self.assertIsNone(get_node_by_slug('slug'))
+
+        a = Node(_id='00000a', title=u'A', slug='slug')
+        a.save()
+        self.assertEqual(get_node_by_slug('slug')._id, '00000a')
+
+        # Cached slug is resolved without querying view.
+        with patch.object(couch, 'rows') as rows:
+            self.assertEqual(get_node_by_slug('slug')._id, '00000a')
+            self.assertFalse(rows.called)
+
+        b = Node(_id='00000b', title=u'B', slug='slug')
+        b.save()
+        with patch.object(couch, 'bulk_save') as bulk_save:
+            nodes = get_node_by_slug('slug')
+            self.assertFalse(bulk_save.called)
+        self.assertTrue(IViewResults.providedBy(nodes))
+        self.assertEqual(sorted(node._id for node in nodes),
+                         ['00000a', '00000b'])
+
+        # Ambiguous flags are set, when node is saved.
+        self.assertTrue(all(node.ambiguous for node in nodes))
+        self.assertTrue(couch.get('00000a')._rev.startswith('2-'))
+
+        # Changed slug invalidates both, old and new slug.
+        b = couch.get('00000b')
+        b.slug = 'other'
+        b.save()
+        self.assertEqual(get_node_by_slug('slug')._id, '00000a')
+        self.assertEqual(get_node_by_slug('other')._id, '00000b')
+        self.assertFalse(couch.get('00000a').ambiguous)
+        self.assertFalse(couch.get('00000b').ambiguous)
+
+        couch.get('00000a').delete()
+        self.assertIsNone(get_node_by_slug('slug'))
+
+        # Nodes without slug are not reconciled.
+        with patch.object(couch, 'rows', wraps=couch.rows) as rows:
+            Node(_id='00000c', title=u'C').save()
+        self.assertFalse(rows.called)
+
+
+class TestCategoryTree(NodesTestsMixin, TestCase):
+    def test_tree(self):
+        root = Node(_id='000000', title=u'Root')
+        nodes = [root]
+        for i in range(3):
+            child = Node(_id='00000%d' % (i + 1), title=u'Child %d' % i)
+            child.set_parent(root)
+            nodes.append(child)
+            for j in range(2):
+                grandchild = Node(_id='0000%d%d' % (i + 1, j),
+                                  title=u'Grandchild %d' % j)
+                grandchild.set_parent(child)
+                nodes.append(grandchild)
+        deep = Node(_id='000100', title=u'Deep')
+        deep.set_parent(nodes[5])
+        nodes.append(deep)
+        couch.bulk_save(nodes)
+
+        rows = list(query_tree(root, depth=1, limit=2))
+        self.assertEqual([row['key'] for row in rows],
+                         [['000001'], ['000002']])
+        self.assertEqual([row['more'] for row in rows], [False, True])
+        self.assertTrue(all(row['has_children'] for row in rows))
+
+        rows = list(query_tree(root, depth=2, after='000001'))
+        self.assertEqual([row['id'] for row in rows],
+                         ['000002', '000020', '000021', '000003', '000030',
+                          '000031'])
+        self.assertEqual([row['value']['title'] for row in rows[:2]],
+                         [u'Child 1', u'Grandchild 0'])
+        self.assertEqual([row['has_children'] for row in rows],
+                         [True, True, False, True, False, False])
+
+        rows = get_tree(root, depth=2, limit=1)
+        self.assertEqual([(row['id'], row['level']) for row in rows],
+                         [('000001', 1), ('000010', 2)])
+
+        # Cached subtree is reused, until node in it is changed.
+        Node(_id='000200', title=u'Other').save()
+        with patch.object(couch, 'multi_query') as multi_query:
+            self.assertEqual(get_tree(root, depth=2, limit=1), rows)
+        self.assertFalse(multi_query.called)
+        grandchild = couch.get('000010')
+        grandchild.title = u'Renamed'
+        grandchild.save()
+        rows = get_tree(root, depth=2, limit=1)
+        self.assertEqual(rows[1]['value']['title'], u'Renamed')
+
+        url = reverse('node_ext', args=['000000', 'tree', 'json'])
+        response = self.client.get(url, {'depth': '1', 'after': '000002'})
+        self.assertEqual(json.loads(response.content), [{
+            'id': '000003', 'title': 'Child 2', 'slug': None,
+            'has_children': True, 'more': False, 'children': [],
+        }])
+
+        # Next page starts after deleted node too.
+        couch.get('000001').delete()
+        rows = list(query_tree(root, depth=1, limit=1, after='000001'))
+        self.assertEqual([(row['id'], row['more']) for row in rows],
+                         [('000002', True)])
+
+
+class TestChildren(NodesTestsMixin, TestCase):
+    def test_children(self):
+        parents = [Node(_id='00000%d' % i, title=u'Parent') for i in range(3)]
+        couch.bulk_save(parents)
+        children = []
+        for i in range(4):
+            child = Node(title=u'Child %d' % i,
+                         created=datetime.datetime(2013, 1, i + 1))
+            child.set_parent(parents[0])
+            children.append(child)
+        child = Node(title=u'Child')
+        child.set_parent(parents[1])
+        children.append(child)
+        couch.bulk_save(children)
+
+        ids = [parent._id for parent in parents]
+        self.assertEqual(couch.children_counts(ids),
+                         {'000000': 4, '000001': 1, '000002': 0})
+
+        latest = couch.latest_children(ids, 2)
+        self.assertEqual([node.title for node in latest['000000']],
+                         [u'Child 3', u'Child 2'])
+        self.assertEqual(len(latest['000001']), 1)
+        self.assertEqual(latest['000002'], [])
+
+        prefetch_children(parents)
+        with patch.object(Node, 'get_db') as get_db:
+            self.assertEqual(parents[0].get_children_count(), 4)
+            self.assertEqual(len(parents[0].get_latest_children()), 3)
+            self.assertFalse(get_db.called)
+
+
+class TestCommentThreads(NodesTestsMixin, TestCase):
+    def comment(self, parent, title, minute=0):
+        comment = Comment(title=title)
+        comment.created = datetime.datetime(2013, 1, 1, 12, minute)
+        comment.set_parent(parent)
+        return comment
+
+    def test_comment_threads(self):
+        node = Node(_id='000001', title=u'Node')
+        node.save()
+        c1 = self.comment(node, u'c1', 1)
+        c2 = self.comment(node, u'c2', 2)
+        couch.bulk_save([c1, c2])
+        r1 = self.comment(c1, u'r1')
+        couch.bulk_save([r1])
+        r2 = self.comment(r1, u'r2')
+        couch.bulk_save([r2])
+        r3 = self.comment(r2, u'r3')
+        couch.bulk_save([r3])
+        self.assertEqual(r3.thread, node._id)
+
+        # Replies deeper than depth are counted, but not fetched.
+        with patch.object(couch, 'get_many', wraps=couch.get_many) as get:
+            threads = get_comment_threads(node, depth=2)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(sorted(get.call_args[0][0]),
+                         sorted([c1._id, c2._id, r1._id]))
+
+        # Newest comments first.
+        self.assertEqual([t.comment.title for t in threads], [u'c2', u'c1'])
+        self.assertEqual([(t.comment.title, t.level) for t in threads.objects[1]],
+                         [(u'c1', 1), (u'r1', 2)])
+        self.assertEqual(threads.objects[1].replies[0].hidden_replies, 2)
+
+        # Top-level comments are paginated.
+        page = get_comment_threads(node, depth=2, limit=1)
+        self.assertEqual([t.comment.title for t in page], [u'c2'])
+        page = get_comment_threads(node, depth=2, limit=1,
+                                   token=page.next_token)
+        self.assertEqual([t.comment.title for t in page.objects[0]], [u'c1', u'r1'])
+        self.assertFalse(page.has_next())
+
+        url = reverse('node', args=[node._id])
+        with patch.object(DetailsView, 'paginate_by', 1):
+            response = self.client.get(url)
+        self.assertContains(response, 'class="pager"')
+
+        # Replies of a comment.
+        threads = get_comment_threads(r1, depth=5)
+        self.assertEqual([t.comment.title for t in threads.objects[0]],
+                         [u'r2', u'r3'])
+
+        url = reverse('node_ext', args=[r1._id, 'comments', 'json'])
+        response = self.client.get(url, {'depth': 1})
+        data = json.loads(response.content)
+        self.assertEqual([c['id'] for c in data], [r2._id])
+        self.assertEqual(data[0]['hidden_replies'], 1)
+
+
+    def test_comments_without_thread(self):
+        node = Node(_id='000001', title=u'Node')
+        node.save()
+        c1 = self.comment(node, u'c1')
+        c1.thread = None
+        c1.save()
+
+        # Comment without thread is shown without replies.
+        threads = get_comment_threads(node)
+        self.assertEqual([t.comment.title for t in threads], [u'c1'])
+
+        # Reply gets thread from ancestors.
+        r1 = self.comment(c1, u'r1')
+        self.assertEqual(r1.thread, node._id)
+        r1.save()
+        r2 = self.comment(c1, u'r2')
+        r2.thread = c1._id
+        r2.save()
+
+        call_command('sboard_thread_comments', stdout=StringIO.StringIO())
+        self.assertEqual(couch.get(c1._id).thread, node._id)
+        self.assertEqual(couch.get(r2._id).thread, node._id)
+        threads = get_comment_threads(node)
+        self.assertEqual(
+            sorted(t.comment.title for t in threads.objects[0]),
+            [u'c1', u'r1', u'r2'])
+
+class TestNodeViewDispatch(unittest.TestCase):
+    def setUp(self):
+        clear_view_dispatch_cache()
+        self.node = Node(_id='000001', title=u'Node')
+
+    def test_get_node_view(self):
+        for i in range(2):
+            self.assertIsInstance(get_node_view(self.node), DetailsView)
+            self.assertIsInstance(get_node_view(self.node, 'create', 'node'),
+                                  CreateView)
+            self.assertIsInstance(get_node_view(self.node, ext='json'),
+                                  JsonView)
+            self.assertRaises(ComponentLookupError, get_node_view,
+                              self.node, 'not-existing-action')
+
+    def test_invalidation(self):
+        self.assertRaises(ComponentLookupError, get_node_view,
+                          self.node, 'test-dispatch')
+
+        class TestView(DetailsView):
+            adapts(INode)
+
+        provideAdapter(TestView, name='test-dispatch')
+        try:
+            self.assertIsInstance(get_node_view(self.node, 'test-dispatch'),
+                                  TestView)
+        finally:
+            getSiteManager().unregisterAdapter(TestView, name='test-dispatch')
+
+    def test_unregistration(self):
+        class TestView(DetailsView):
+            adapts(INode)
+
+        provideAdapter(TestView, name='test-dispatch')
+        self.assertIsInstance(get_node_view(self.node, 'test-dispatch'),
+                              TestView)
+        getSiteManager().unregisterAdapter(TestView, name='test-dispatch')
+        self.assertRaises(ComponentLookupError, get_node_view,
+                          self.node, 'test-dispatch')
+
+    def test_benchmark(self):
+        def lookups_per_second(clear):
+            count = 2000
+            started = time.time()
+            for i in range(count):
+                if clear:
+                    clear_view_dispatch_cache()
+                get_node_view(self.node, 'create', 'node')
+                get_node_view(self.node, 'list')
+            return count * 2 / max(time.time() - started, 0.001)
+
+        with patch('sboard.views._lookup_node_view',
+                   wraps=_lookup_node_view) as lookup:
+            uncached = lookups_per_second(clear=True)
+            self.assertEqual(lookup.call_count, 4000)
+            cached = lookups_per_second(clear=False)
+            self.assertEqual(lookup.call_count, 4000)
+        print('get_node_view: %d lookups/s uncached, %d lookups/s cached'
+              % (uncached, cached))
+
+
+class TestNodeSummary(unittest.TestCase):
+    def test_summary(self):
+        summary = NodeSummary('000001', {
+            'title': u'Title',
+            'created': '2013-01-02T03:04:05Z',
+            'slug': 'title',
+            'ambiguous': True,
+            'doc_type': 'node',
+        })
+        self.assertFalse(hasattr(summary, '__dict__'))
+        self.assertEqual(summary.created,
+                         datetime.datetime(2013, 1, 2, 3, 4, 5))
+        self.assertEqual(summary.urlslug(), 'title+000001')
+
+        summary = NodeSummary('000002', {'title': u'Title'})
+        self.assertEqual(summary.permalink(ext='json'), '/000002.json')
+
+
+class TestProfileAvatars(NodesTestsMixin, TestCase):
+    def test_avatars(self):
+        profiles = Profile.objects.order_by('pk')
+        keys = [profile.node.key for profile in profiles]
+
+        with self.assertNumQueries(0):
+            avatars = query_profile_avatars(keys, size=24)
+        self.assertEqual([p.username for p, url in avatars],
+                         ['superuser', 'u1', 'u2', 'u3'])
+        self.assertEqual(avatars[1][1], (
+            'http://www.gravatar.com/avatar/%s?s=24' %
+            get_gravatar_hash('u1@example.com')))
+
+        # Changed email updates gravatar hash.
+        user = get_user_model().objects.get(username='u1')
+        user.email = 'U1@Example.org'
+        user.save()
+        node = couch.get(keys[1])
+        self.assertEqual(node.gravatar_hash,
+                         get_gravatar_hash('u1@example.org'))
+        self.assertIn(node.gravatar_hash, node.image_url(size=40))
+
+
+class TestNodeImage(unittest.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.old_async = getattr(settings, 'SBOARD_NODEIMAGE_ASYNC', True)
+        settings.SBOARD_NODEIMAGE_ASYNC = False
+
+    def tearDown(self):
+        settings.SBOARD_NODEIMAGE_ASYNC = self.old_async
+        cache.clear()
+
+    def get_node(self, key):
+        image = ImageNode(_id='i%s' % key, ext='png')
+        image._doc['_rev'] = '1-a'
+        image.thumbnail = lambda geometry: type(
+            'Thumbnail', (object,), {'url': '/%s.png' % image._rev})
+        node = Node(_id=key, title=u'Node %s' % key)
+        node._doc['_rev'] = '1-a'
+        node.image = image
+        return node
+
+    @patch('sboard.templatetags.sboard.margin', lambda *args: '0px')
+    def test_nodeimages(self):
+        nodes = [self.get_node('00000%d' % i) for i in range(3)]
+        template = Template(
+            '{% load sboard %}{% nodeimages nodes "small" %}'
+            '{% for node in nodes %}{% nodeimage node "small" %}{% endfor %}'
+            '{% endnodeimages %}')
+        html = template.render(Context({'nodes': nodes}))
+        self.assertEqual(html.count('src="/1-a.png"'), 3)
+
+        # Second time all tags are fetched from cache with one request.
+        with patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(template.render(Context({'nodes': nodes})), html)
+        self.assertEqual(get_many.call_count, 1)
+
+        # Replaced image gets new cache key.
+        nodes[0].image.ref._doc['_rev'] = '2-b'
+        images = get_node_images(nodes, 'small')
+        self.assertIn('src="/2-b.png"', images['000000'])
+        self.assertIn('src="/1-a.png"', images['000001'])
+
+    @patch('sboard.templatetags.sboard.generate_nodeimage')
+    def test_placeholder(self, generate_nodeimage):
+        generate_nodeimage.return_value = None
+        node = self.get_node('000001')
+        html = get_node_images([node])['000001']
+        self.assertIn(NODEIMAGE_PLACEHOLDER, html)
+        self.assertIn('width="40"', html)
+        self.assertEqual(generate_nodeimage.call_count, 1)
+
+
+class TestNodeListImages(NodesTestsMixin, TestCase):
+    @patch('sboard.templatetags.sboard.generate_nodeimage')
+    def test_node_list_images(self, generate_nodeimage):
+        generate_nodeimage.return_value = None
+        parent = Node(_id='000001', title=u'Parent')
+        parent.save()
+        image = ImageNode(_id='000002', ext='png')
+        image.save()
+        child = Node(title=u'Child')
+        child.set_parent(parent)
+        child.image = image
+        child.save()
+
+        children = NodeView(parent).get_node_list()
+        template = Template('{% load sboard %}{% for child in children %}'
+                            '{% nodeimage child %}{% endfor %}')
+        html = template.render(Context({'children': children}))
+        self.assertIn(NODEIMAGE_PLACEHOLDER, html)
+
+        # Default node list template needs only summaries.
+        children = ListView(parent).get_node_list()
+        self.assertIsInstance(children.objects[0], NodeSummary)
+
+    @patch('sboard.templatetags.sboard.generate_nodeimage')
+    def test_placeholder_etag(self, generate_nodeimage):
+        generate_nodeimage.return_value = None
+        image = ImageNode(_id='000002', ext='png')
+        image.save()
+        node = Node(_id='000001', title=u'Node')
+        node.image = image
+        node.save()
+
+        request = RequestFactory().get('/')
+        template = Template('{% load sboard %}{% nodeimage node %}')
+        view = Mock(request=request)
+        view.get_etag.return_value = 'etag'
+        view.get_last_modified.return_value = None
+        view.render.side_effect = lambda: HttpResponse(template.render(
+            Context({'request': request, 'node': node})))
+
+        # Placeholder is replaced later, so page is not validated by ETag.
+        response = render_conditional(view)
+        self.assertIn(NODEIMAGE_PLACEHOLDER, response.content)
+        self.assertNotIn('ETag', response)
+
+class TestRenderImage(TestCase):
+    def setUp(self):
+        self.old_media_root = settings.MEDIA_ROOT
+        settings.MEDIA_ROOT = os.path.join(
+                settings.BUILDOUT_DIR, 'var', 'test-media')
+        invalidate_normal_image('000123')
+
+    def tearDown(self):
+        invalidate_normal_image('000123')
+        if os.path.exists(settings.MEDIA_ROOT):
+            shutil.rmtree(settings.MEDIA_ROOT)
+        settings.MEDIA_ROOT = self.old_media_root
+
+    def get_image_node(self):
+        image = PILImage.new('RGB', (2000, 1000))
+        data = StringIO.StringIO()
+        image.save(data, 'PNG')
+
+        node = ImageNode(_id='000123', ext='png')
+        node._doc['_rev'] = '1-a'
+        node._doc['_attachments'] = {'file.png': {'digest': 'md5-a'}}
+        node.fetch_attachment = lambda *args, **kwargs: (
+            StringIO.StringIO(data.getvalue()))
+        return node
+
+    @patch.object(couch, 'get')
+    def test_render_image(self, get):
+        get.return_value = self.get_image_node()
+        url = reverse('media_normal_size', args=['000123', 'png'])
+
+        with patch('sboard.views.get_normal_image',
+                   wraps=get_normal_image) as lookup:
+            response = self.client.get(url)
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        image = PILImage.open(StringIO.StringIO(response.content))
+        self.assertEqual(image.size, (724, 362))
+        path = get_normal_image('000123', 'png')['path']
+        self.assertEqual(os.stat(path).st_mode & 0o777, FILE_MODE)
+
+        # Rendered image is reused and validated without CouchDB.
+        get.side_effect = AssertionError('CouchDB must not be used.')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class TestRenderBody(unittest.TestCase):
+    @patch.object(Node, 'get_body')
+    def test_render_body(self, get_body):
+        get_body.return_value = 'new *body*'
+
+        node = Node()
+        node.set_body_html('some *body*')
+        self.assertEqual(node.render_body(), '<p>some <em>body</em></p>\n')
+        self.assertEqual(get_body.call_count, 0)
+
+        # Body must be rendered again if markup settings changes.
+        with patch.object(settings, 'RESTRUCTUREDTEXT_FILTER_SETTINGS',
+                          {'initial_header_level': 2}, create=True):
+            self.assertEqual(node.render_body(), '<p>new <em>body</em></p>\n')
+        self.assertEqual(get_body.call_count, 1)
+
+
+class TestSetBody(NodesTestsMixin, TestCase):
+    def test_set_body(self):
+        node = Node(_id='000001', title=u'Node', body=u'old *body*')
+        node.save()
+        node.set_body(u'new *body*')
+
+        node = couch.get('000001')
+        self.assertEqual(node.body_html, u'<p>new <em>body</em></p>\n')
+        self.assertEqual(node.get_body(), 'new *body*')
 
 class FakeNodeWithRef(BaseNode):
     photo = NodeProperty()
@@ -274,6 +1074,291 @@ class TestNodeRef(unittest.TestCase):
         self.assertFalse(node.photo)
 
 
+class TestPrefetchNodes(unittest.TestCase):
+    @patch.object(Node, 'get_db')
+    def test_prefetch(self, get_db):
+        db = get_db.return_value
+        db.view.return_value = [
+            {'id': 'p1', 'doc': {'_id': 'p1', 'doc_type': 'Node'}},
+            {'id': 'p2', 'doc': {'_id': 'p2', 'doc_type': 'Node'}},
+            {'key': 'missing', 'error': 'not_found'},
+        ]
+
+        nodes = [couch.wrap({'_id': 'n%d' % i, 'doc_type': 'FakeNodeWithRef',
+                             'photo': photo})
+                 for i, photo in enumerate(['p1', 'p2', 'p1', None, 'missing'])]
+
+        prefetch_nodes('photo', nodes)
+
+        self.assertEqual(db.view.call_count, 1)
+        self.assertEqual(db.view.call_args[1]['keys'], ['p1', 'p2', 'missing'])
+        self.assertEqual(nodes[0].photo.ref._id, 'p1')
+        self.assertEqual(nodes[1].photo.ref._id, 'p2')
+        self.assertIs(nodes[0].photo.ref, nodes[2].photo.ref)
+        self.assertIsNone(nodes[3].photo)
+        self.assertEqual(db.view.call_count, 1)
+
+
+class TestNodeIdentityMap(unittest.TestCase):
+    def setUp(self):
+        self.identity_map = activate_identity_map()
+        self.addCleanup(deactivate_identity_map)
+
+    @patch.object(Node, 'get_db')
+    def test_get(self, get_db):
+        db = get_db.return_value
+        db.get.side_effect = lambda docid, rev, wrapper: wrapper({
+            '_id': docid,
+            'doc_type': 'Node',
+        })
+
+        node = couch.get('000001')
+        self.assertIs(couch.get('000001'), node)
+        self.assertEqual(db.get.call_count, 1)
+        self.assertEqual(self.identity_map.hits, 1)
+        self.assertEqual(self.identity_map.misses, 1)
+
+        # Specific revisions are always fetched from database.
+        couch.get('000001', rev='1-abc')
+        self.assertEqual(db.get.call_count, 2)
+
+        deactivate_identity_map()
+        self.assertIsNot(couch.get('000001'), node)
+        self.assertEqual(db.get.call_count, 3)
+
+
+class TestCompilePermissions(unittest.TestCase):
+    def _node(self, docid, *permissions):
+        node = Node()
+        node._id = docid
+        node.permissions = [list(p) for p in permissions]
+        return node
+
+    @patch('sboard.models.couch')
+    def test_compile_permissions(self, couch_mock):
+        root = self._node('~', ('create', 'all', None, None, 0))
+        c1 = self._node('c1', ('create', 'all', None, None, None))
+        couch_mock.get_revs.return_value = {'~': '1-a', 'c1': '1-a'}
+        couch_mock.get_many.return_value = {'~': root, 'c1': c1}
+
+        permissions = compile_permissions(['~', 'c1'])
+        key = ('create', 'all', None, None)
+        self.assertIsNone(permissions.permissions[key])
+        self.assertEqual(couch_mock.get_many.call_count, 1)
+
+        # Nodes with same ancestors share compiled permissions.
+        permissions.update([('update', 'all', None, None, 0)])
+        permissions = compile_permissions(['c1'])
+        self.assertEqual(permissions.permissions, {key: None})
+        self.assertEqual(couch_mock.get_many.call_count, 1)
+
+        # Permissions are compiled again, when any of ancestors changes.
+        c1.permissions = []
+        couch_mock.get_revs.return_value = {'~': '1-a', 'c1': '2-b'}
+        permissions = compile_permissions(['c1'])
+        self.assertEqual(permissions.permissions[key], 0)
+        self.assertEqual(couch_mock.get_many.call_count, 2)
+
+    def test_update_does_not_change_rows(self):
+        row = ['create', 'all', None, None, 0]
+        Permissions().update([row])
+        self.assertEqual(row, ['create', 'all', None, None, 0])
+
+
+class TestPermissionDecisions(unittest.TestCase):
+    def get_request(self, karma):
+        request = RequestFactory().get('/')
+        request.user = Mock(pk=1, is_superuser=False)
+        request.user.is_authenticated.return_value = True
+        request.user.get_profile.return_value = Mock(karma=karma)
+        return request
+
+    def test_allows(self):
+        request = self.get_request(karma=5)
+        permissions = Permissions()
+        permissions.update([('create', 'all', 'authenticated', None, 1),
+                            ('update', 'all', 'authenticated', None, 10)])
+        self.assertTrue(permissions.allows(request, 'create', 'node'))
+        self.assertFalse(permissions.allows(request, 'update', 'node'))
+
+        # Equal permission tables share decisions and profile is loaded once.
+        with patch.object(Permissions, 'can') as can:
+            other = Permissions(permissions.permissions)
+            self.assertTrue(other.allows(request, 'create', 'node'))
+            self.assertFalse(can.called)
+        self.assertEqual(request.user.get_profile.call_count, 1)
+
+        # Changed table gets new decisions.
+        other.update([('create', 'all', 'authenticated', None, 10)])
+        self.assertFalse(other.allows(request, 'create', 'node'))
+        self.assertEqual(request.user.get_profile.call_count, 1)
+
+    def test_can_many(self):
+        request = self.get_request(karma=5)
+        node = Node()
+        node._permissions = Permissions()
+        node._permissions.update([('create', 'all', None, None, 0)])
+        self.assertEqual(
+            node.can_many(request, [('create', 'node'), ('delete', 'node')]),
+            [True, False])
+
+
+class TestPaginate(unittest.TestCase):
+    def setUp(self):
+        # Two rows share same key, to check, that pages are split by docid.
+        self.rows = [{'key': k, 'id': '%02d' % i}
+                     for i, k in enumerate([1, 2, 2, 3, 4, 5, 6])]
+
+    def query(self, startkey=None, endkey=None, startkey_docid=None,
+              descending=False, limit=None, include_docs=False):
+        rows = sorted(self.rows, key=lambda r: (r['key'], r['id']),
+                      reverse=descending)
+        if startkey is not None:
+            start = (startkey, startkey_docid or '')
+            rows = [r for r in rows if ((r['key'], r['id']) <= start
+                                        if descending else
+                                        (r['key'], r['id']) >= start)]
+            if startkey_docid is None and descending:
+                rows = [r for r in rows if r['key'] <= startkey]
+        if endkey is not None:
+            rows = [r for r in rows
+                    if (r['key'] >= endkey if descending else
+                        r['key'] <= endkey)]
+        return rows[:limit]
+
+    def ids(self, page):
+        return [row['id'] for row in page]
+
+    def test_paginate(self):
+        wrap = lambda row: row
+        page = paginate(self.query, wrap, limit=3)
+        self.assertEqual(self.ids(page), ['00', '01', '02'])
+        self.assertFalse(page.has_previous())
+
+        page = paginate(self.query, wrap, token=page.next_token, limit=3)
+        self.assertEqual(self.ids(page), ['03', '04', '05'])
+
+        page = paginate(self.query, wrap, token=page.next_token, limit=3)
+        self.assertEqual(self.ids(page), ['06'])
+        self.assertFalse(page.has_next())
+
+        page = paginate(self.query, wrap, token=page.previous_token, limit=3)
+        self.assertEqual(self.ids(page), ['03', '04', '05'])
+
+        page = paginate(self.query, wrap, token=page.previous_token, limit=3)
+        self.assertEqual(self.ids(page), ['00', '01', '02'])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_invalid_token(self):
+        page = paginate(self.query, lambda row: row, token='garbage', limit=3)
+        self.assertEqual(self.ids(page), ['00', '01', '02'])
+
+    def test_token_out_of_range(self):
+        wrap = lambda row: row
+        ranges = [dict(startkey=2, endkey=5),
+                  dict(startkey=5, endkey=2, descending=True)]
+        for kwargs in ranges:
+            first = self.ids(paginate(self.query, wrap, limit=2, **kwargs))
+            for direction in (NEXT, PREVIOUS):
+                for row in ({'key': 1, 'id': '00'}, {'key': 6, 'id': '06'}):
+                    token = encode_token(direction, row)
+                    page = paginate(self.query, wrap, token=token, limit=2,
+                                    **kwargs)
+                    self.assertEqual(self.ids(page), first)
+
+        # Array keys of other parent.
+        self.assertTrue(in_range(['a', '2013'], ['a', 'Z'], ['a'], True))
+        self.assertFalse(in_range(['b', '2013'], ['a', 'Z'], ['a'], True))
+        self.assertFalse(in_range(['0', '2013'], ['a', 'Z'], ['a'], True))
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex(':memory:')
+
+    def node(self, key, title, body=u'', importance=5, **kwargs):
+        node = Node(_id=key, title=title, importance=importance, **kwargs)
+        node.body_html = u'<p>%s</p>' % body
+        return node
+
+    def search(self, query):
+        return self.index.search(get_search_terms(query))
+
+    def test_search(self):
+        self.index.update([
+            self.node('000001', u'Šilta vasara', u'Karšta diena'),
+            self.node('000002', u'Diena', u'Šilta ir saulėta vasara'),
+            self.node('000003', u'Vasara', keywords=[u'šilta']),
+            self.node('000004', u'Šilta vasara', importance=0),
+        ])
+        # All terms must match, body matches are ranked lowest.
+        found = self.search(u'šilta vasara')
+        self.assertEqual(sorted(found[:2]), ['000001', '000003'])
+        self.assertEqual(found[2:], ['000002'])
+        self.assertEqual(self.search(u'diena karšta'), ['000001'])
+        self.assertEqual(self.search(u'"; DROP'), [])
+
+        # Reindexing replaces old node data.
+        self.index.update([self.node('000001', u'Ruduo')])
+        self.assertEqual(self.search(u'šilta vasara'), ['000003', '000002'])
+
+        self.index.delete('000003')
+        self.assertEqual(self.search(u'šilta vasara'), ['000002'])
+
+    def test_importance(self):
+        self.index.update([
+            self.node('000001', u'Vasara', importance=1),
+            self.node('000002', u'Vasara', importance=10),
+        ])
+        self.assertEqual(self.search(u'vasara'), ['000002', '000001'])
+
+
+class TestKeyAllocator(NodesTestsMixin, TestCase):
+    def test_allocate(self):
+        # Key, generated one by one before blocks were introduced.
+        legacy = UniqueKey()
+        legacy.save()
+        legacy.key = base36(legacy.pk).zfill(6)
+        legacy.save()
+        legacy_key = legacy.key._id
+
+        allocator = KeyAllocator()
+        with patch.object(settings, 'SBOARD_KEY_BLOCK_SIZE', 10, create=True):
+            keys = allocator.allocate(25)
+            keys.extend(allocator.allocate()[0] for i in range(5))
+
+        self.assertEqual(len(set(keys)), 30)
+        self.assertTrue(all(len(key) == 6 for key in keys))
+        self.assertEqual(UniqueKey.objects.count(), 4)
+
+        # Blocks start above previously generated keys.
+        self.assertTrue(all(key > legacy_key for key in keys))
+
+        # Biggest reserved key is stored in CouchDB.
+        self.assertGreaterEqual(get_key_high_water(),
+                                max(int(key, 36) for key in keys))
+
+    def test_create(self):
+        with patch.object(settings, 'SBOARD_KEY_BLOCK_SIZE', 10, create=True):
+            with patch('sboard.models.key_allocator', KeyAllocator()):
+                keys = get_new_ids(15)
+                keys.extend(UniqueKey.objects.create().key._id
+                            for i in range(15))
+        self.assertEqual(len(set(keys)), 30)
+        # Only blocks are stored.
+        self.assertEqual(UniqueKey.objects.count(), 3)
+
+    @patch('os.getpid')
+    def test_fork(self, getpid):
+        allocator = KeyAllocator()
+        getpid.return_value = 1
+        allocator.allocate()
+        getpid.return_value = 2
+        allocator.allocate()
+        self.assertEqual(UniqueKey.objects.count(), 2)
+
+
 class TestNodeForeignKey(unittest.TestCase):
     @patch('sboard.models.couch')
     def test_field(self, couch_mock):
@@ -1,53 +1,109 @@
-import StringIO
-
-from PIL import Image
+import calendar
+import datetime
 
 from zope.component import ComponentLookupError
-from zope.component import getAdapter
-from zope.component import getMultiAdapter
-from zope.component import getUtility
+from zope.component import getSiteManager
+from zope.interface import providedBy
 
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.utils.http import parse_etags
+from django.utils.http import parse_http_date_safe
+from django.utils.http import quote_etag
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
-from couchdbkit.client import ViewResults
 from couchdbkit.exceptions import MultipleResultsFound
 
 from .factory import INodeFactory
 from .factory import IViewExtFactory
+from .factory import clear_view_dispatch_cache
+from .factory import view_dispatch_cache
 from .factory import get_search_handlers
 from .interfaces import INodeView
+from .interfaces import IViewResults
 from .models import couch
 from .models import get_node_by_slug
+from .models import get_normal_image
+from .templatetags.sboard import NODEIMAGE_PLACEHOLDER_SHOWN
 
+# How long browsers may use normal size images without asking again.
+NORMAL_IMAGE_MAX_AGE = 24 * 60 * 60
 
-def get_node_view(node, action='', name='', ext=''):
+
+# Maximum number of cached view lookups, unknown actions from urls are cached
+# too, so cache must be bounded.
+VIEW_DISPATCH_CACHE_SIZE = 1000
+
+
+
+def _lookup_node_view(spec, action, name, ext, is_view_results):
+    """Returns ``(factory, args)`` tuple of view for node providing ``spec``,
+    where view is ``factory(node, *args)``, or None if view is not found."""
+    registry = getSiteManager()
     if ext:
-        view_interface = getUtility(IViewExtFactory, ext).interface
+        ext_factory = registry.utilities.lookup((), IViewExtFactory, ext)
+        if ext_factory is None:
+            return None
+        view_interface = ext_factory.interface
     else:
         view_interface = INodeView
 
-    if isinstance(node, ViewResults):
-        return getAdapter(node, view_interface)
+    def lookup(required, name):
+        return registry.adapters.lookup(required, view_interface, name)
+
+    if is_view_results:
+        factory = lookup((spec,), u'')
+        return (factory, ()) if factory else None
 
-    view = None
     if name:
-        try:
-            factory = getUtility(INodeFactory, name)
-        except ComponentLookupError:
+        node_factory = registry.utilities.lookup((), INodeFactory, name)
+        if node_factory is None:
             # /node/action/name/ - dynamic action, static name
-            view = getMultiAdapter((node, action), view_interface, name)
+            factory = lookup((spec, providedBy(action)), name)
+            return (factory, (action,)) if factory else None
         else:
             # /node/action/factory/ - static action
-            view = getMultiAdapter((node, factory), view_interface, action)
+            factory = lookup((spec, providedBy(node_factory)), action)
+            return (factory, (node_factory,)) if factory else None
     else:
-        try:
-            # /node/action/ - static action
-            view = getAdapter(node, view_interface, action)
-        except ComponentLookupError:
-            # /node/action/ - dynamic action
-            view = getMultiAdapter((node, action), view_interface)
+        # /node/action/ - static action
+        factory = lookup((spec,), action)
+        if factory is not None:
+            return (factory, ())
+        # /node/action/ - dynamic action
+        factory = lookup((spec, providedBy(action)), u'')
+        return (factory, (action,)) if factory else None
+
+
+def get_node_view(node, action='', name='', ext=''):
+    """Returns view of ``node`` or raises ``ComponentLookupError``.
+
+    Resolved view factories, including not found views, are cached by
+    interfaces provided by node, action, name and ext. Cache is cleared, when
+    views are provided with ``sboard.factory.provideAdapter`` or other
+    ``provide*`` functions of ``sboard.factory``.
+    """
+    spec = providedBy(node)
+    key = (spec, action, name, ext)
+    try:
+        found = view_dispatch_cache[key]
+    except KeyError:
+        is_view_results = IViewResults.providedBy(node)
+        found = _lookup_node_view(spec, action, name, ext, is_view_results)
+        if len(view_dispatch_cache) >= VIEW_DISPATCH_CACHE_SIZE:
+            view_dispatch_cache.clear()
+        view_dispatch_cache[key] = found
 
+    view = None
+    if found is not None:
+        factory, args = found
+        view = factory(node, *args)
+    if view is None:
+        raise ComponentLookupError(node, action, name, ext)
     return view
 
 
@@ -56,7 +112,7 @@ def node_view(request, slug=None, action='', name='', ext=''):
     if node is None:
         raise Http404
 
-    if ext and isinstance(node, ViewResults):
+    if ext and IViewResults.providedBy(node):
         length = len(node)
         raise MultipleResultsFound("%s results found." % length)
 
@@ -67,7 +123,57 @@ def node_view(request, slug=None, action='', name='', ext=''):
 
     view.set_request(request)
     view.set_view_func(node_view)
-    return view.validate() or view.render()
+    return view.validate() or render_conditional(view)
+
+
+def render_conditional(view):
+    """Renders ``view`` or returns 304 response, if client already has
+    current version of it.
+
+    Response is validated by ``ETag`` and ``Last-Modified`` headers, returned
+    by view ``get_etag`` and ``get_last_modified`` methods, before rendering
+    anything.
+    """
+    request = view.request
+    if request.method not in ('GET', 'HEAD'):
+        return view.render()
+
+    etag = view.get_etag()
+    last_modified = view.get_last_modified()
+    if etag is None and last_modified is None:
+        return view.render()
+
+    if last_modified is not None:
+        last_modified = calendar.timegm(last_modified.utctimetuple())
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match and etag is not None:
+        etags = parse_etags(if_none_match)
+        not_modified = etag in etags or '*' in etags
+    elif if_modified_since and last_modified is not None:
+        not_modified = last_modified <= if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = view.render()
+        if response.status_code != 200:
+            return response
+        if getattr(request, NODEIMAGE_PLACEHOLDER_SHOWN, False):
+            # Page changes, when thumbnails are generated.
+            return response
+
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Pages differ for users with different permissions.
+    patch_vary_headers(response, ('Cookie',))
+    return response
 
 
 def search(request):
@@ -88,17 +194,36 @@ def search(request):
     raise Http404
 
 
-def render_image(request, slug, ext):
-    node = couch.get(slug)
-    infile = node.fetch_attachment('file.%s' % node.ext, stream=True)
+def _get_normal_image(request, slug, ext):
+    """Returns ``get_normal_image`` result, memoized on ``request``, so
+    validators and response share one lookup."""
+    images = request.__dict__.setdefault('_sboard_normal_images', {})
+    if (slug, ext) not in images:
+        images[(slug, ext)] = get_normal_image(slug, ext)
+    return images[(slug, ext)]
 
-    infile = StringIO.StringIO(infile.read())
-    image = Image.open(infile)
-    image.thumbnail((724, 1024), Image.ANTIALIAS)
 
-    response = HttpResponse(mimetype='image/%s' % ext)
+def _normal_image_etag(request, slug, ext):
+    image = _get_normal_image(request, slug, ext)
+    return image['etag'] if image else None
 
-    extmap = {'jpg': 'jpeg',}
-    image.save(response, extmap.get(ext, ext).upper())
 
+def _normal_image_modified(request, slug, ext):
+    image = _get_normal_image(request, slug, ext)
+    if image:
+        return datetime.datetime.utcfromtimestamp(image['modified'])
+
+
+@cache_control(public=True, max_age=NORMAL_IMAGE_MAX_AGE)
+@condition(etag_func=_normal_image_etag,
+           last_modified_func=_normal_image_modified)
+def render_image(request, slug, ext):
+    image = _get_normal_image(request, slug, ext)
+    if image is None:
+        raise Http404
+
+    extmap = {'jpg': 'jpeg',}
+    with open(image['path'], 'rb') as f:
+        response = HttpResponse(f.read(), content_type='image/%s' %
+                                extmap.get(ext, ext))
     return response